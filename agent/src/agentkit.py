@@ -1,7 +1,12 @@
-from asyncio import run
+from __future__ import annotations
+
+from asyncio import Queue, create_task, gather, get_running_loop, run, to_thread
+from importlib import import_module
+from inspect import isawaitable
 from json import dumps
 from logging import getLogger
 from os import getenv, makedirs, path
+from typing import TYPE_CHECKING, Any, AsyncIterator
 
 import coloredlogs
 from dotenv import load_dotenv
@@ -12,32 +17,33 @@ coloredlogs.install()
 logger = getLogger("agent")
 
 from aiosqlite import connect
-from coinbase_agentkit import (
-    AgentKit,
-    AgentKitConfig,
-    CdpWalletProvider,
-    CdpWalletProviderConfig,
-    cdp_api_action_provider,
-    wallet_action_provider,
-)
-from coinbase_agentkit_langchain import get_langchain_tools
-from langchain.tools import StructuredTool
-from langchain_core.messages import HumanMessage
-from langchain_openai import ChatOpenAI
-from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
-from langgraph.prebuilt import create_react_agent
-from langgraph.store.memory import InMemoryStore
-
-from models import AgentMessage, UserMessage
+
+from models import AgentMessage, AgentToolEvent, UserMessage
 from prompts import SYSTEM_PROMPT
-from tools import downloader_action_provider, scraper_action_provider
+from tools import (
+    downloader_action_provider,
+    partial_messages,
+    scraper_action_provider,
+)
 
 data_dir = path.join(path.dirname(path.dirname(__file__)), "data")
 database_dir = path.join(data_dir, "database")
 makedirs(database_dir, exist_ok=True)
 
+# langchain, langgraph and the wallet SDK load in Agent.init, in its threads
+if TYPE_CHECKING:
+    from coinbase_agentkit import Action, AgentKit, CdpWalletProvider
+    from langchain.tools import StructuredTool
+    from langchain_openai import ChatOpenAI
+    from langgraph.graph.graph import CompiledGraph
+    from langgraph.store.memory import InMemoryStore
+
+    from checkpoints import CheckpointStore
+
 
 def create_wallet_provider() -> CdpWalletProvider:
+    from coinbase_agentkit import CdpWalletProvider, CdpWalletProviderConfig
+
     # Wallet dir/path
     wallet_data_file = path.join(data_dir, "wallet_data.txt")
 
@@ -65,6 +71,13 @@ def create_wallet_provider() -> CdpWalletProvider:
 
 
 def create_agentkit(wallet_provider: CdpWalletProvider) -> AgentKit:
+    from coinbase_agentkit import (
+        AgentKit,
+        AgentKitConfig,
+        cdp_api_action_provider,
+        wallet_action_provider,
+    )
+
     return AgentKit(
         AgentKitConfig(
             wallet_provider=wallet_provider,
@@ -79,6 +92,8 @@ def create_agentkit(wallet_provider: CdpWalletProvider) -> AgentKit:
 
 
 def create_llm() -> ChatOpenAI:
+    from langchain_openai import ChatOpenAI
+
     llm = ChatOpenAI(
         base_url=getenv("OPENAI_API_BASE"),
         api_key=getenv("OPENAI_API_KEY"),
@@ -89,57 +104,114 @@ def create_llm() -> ChatOpenAI:
     return llm
 
 
+def create_tool(action: Action) -> StructuredTool:
+    from langchain.tools import StructuredTool
+
+    async def tool_coroutine(**kwargs) -> str:
+        # invoke() posts an analytics event synchronously, keep it off the loop,
+        # async actions then run on the server loop with its pooled connections
+        result = await to_thread(action.invoke, kwargs)
+        return await result if isawaitable(result) else result
+
+    return StructuredTool(
+        name=action.name,
+        description=action.description,
+        coroutine=tool_coroutine,
+        args_schema=action.args_schema,
+    )
+
+
 def create_tools(agentkit: AgentKit) -> list[StructuredTool]:
-    tools = get_langchain_tools(agentkit)
     allowed_tools = [
         "CdpApiActionProvider_request_faucet_funds",
         "WalletActionProvider_get_balance",
         "WalletActionProvider_get_wallet_details",
         "ScraperActionProvider_search_torrents",
         "DownloaderActionProvider_download_to_ipfs",
+        "DownloaderActionProvider_get_download_status",
     ]
 
     # Filter CDP Tools
-    tools = [tool for tool in tools if tool.name in allowed_tools]
+    tools = [
+        create_tool(action)
+        for action in agentkit.get_actions()
+        if action.name in allowed_tools
+    ]
     logger.info("Tools: ready")
     return tools
 
 
-async def create_short_term_memory():
-    db_path = path.join(database_dir, "mem.sqlite")
-    memory = AsyncSqliteSaver(connect(db_path))
+async def create_short_term_memory() -> CheckpointStore:
+    # Imported off the loop, the store is then bound to it
+    module = await to_thread(import_module, "checkpoints")
+    memory = module.CheckpointStore(
+        connect(path.join(database_dir, "mem.sqlite"), timeout=10),
+        lock_path=path.join(database_dir, "mem.lock"),
+        keep=int(getenv("CHECKPOINTS_KEPT", "2")),
+        idle_ttl=float(getenv("CHAT_IDLE_DAYS", "30")) * 86400,
+        interval=float(getenv("CHECKPOINTS_COMPACT_INTERVAL", "3600")),
+    )
+    await memory.start()
     logger.info("Short-term Memory: ready")
     return memory
 
 
-def create_long_term_memory():
+def create_long_term_memory() -> InMemoryStore:
+    from langgraph.store.memory import InMemoryStore
+
     memory = InMemoryStore()
     logger.info("Long-term Memory: ready")
     return memory
 
 
+def create_executor(
+    tools: list[StructuredTool], checkpointer: CheckpointStore, llm: ChatOpenAI
+) -> CompiledGraph:
+    from langgraph.prebuilt import create_react_agent
+
+    return create_react_agent(
+        version="v1",
+        name="aipfs-library-agent",
+        prompt=SYSTEM_PROMPT,
+        model=llm,
+        tools=tools,
+        checkpointer=checkpointer,
+        store=create_long_term_memory(),
+    )
+
+
 class Agent:
     agent_executor = None
+    short_term_memory = None
 
     async def init(self):
-        wallet = create_wallet_provider()
-        agentkit = create_agentkit(wallet)
-        tools = create_tools(agentkit)
-        short_term_memory = await create_short_term_memory()
-        long_term_memory = create_long_term_memory()
-
-        self.agent_executor = create_react_agent(
-            version="v1",
-            name="aipfs-library-agent",
-            prompt=SYSTEM_PROMPT,
-            model=create_llm(),
-            tools=tools,
-            checkpointer=short_term_memory,
-            store=long_term_memory,
+        # Wallet, memory and LLM don't depend on each other, only the tools
+        # wait for the wallet. Blocking steps and their imports run in threads
+        tools, self.short_term_memory, llm = await gather(
+            to_thread(lambda: create_tools(create_agentkit(create_wallet_provider()))),
+            create_short_term_memory(),
+            to_thread(create_llm),
+        )
+        self.agent_executor = await to_thread(
+            create_executor, tools, self.short_term_memory, llm
         )
         logger.info("Agent: ready")
 
-    async def chat_stream(self, msg: UserMessage) -> AgentMessage:
+    async def close(self):
+        # Writes the turns still running
+        if self.short_term_memory is not None:
+            await self.short_term_memory.close()
+            self.short_term_memory = None
+
+    async def chat_stream(
+        self, msg: UserMessage
+    ) -> AsyncIterator[tuple[str, AgentMessage | AgentToolEvent]]:
+        # Events: "token" (text generated by the agent, as it comes), "partial"
+        # (partial tool results), "tool_start" and "tool_end", "message" (every
+        # complete agent answer or tool result) and "done" (the whole answer,
+        # as returned by chat)
+        from langchain_core.messages import AIMessageChunk, HumanMessage
+
         new_message = dict(messages=[HumanMessage(content=msg.get("message"))])
         config = dict(
             configurable=dict(
@@ -148,42 +220,120 @@ class Agent:
             )
         )
         ids = dict(user_id=msg.get("user_id"), chat_id=msg.get("chat_id"))
-        async for chunk in self.agent_executor.astream(new_message, config):
-            if "agent" in chunk:
-                content = chunk["agent"]["messages"][0].content.strip()
-                if content:
-                    print(
-                        f"---------- AGENT RESPONSE -----------\n{content}\n---------- AGENT END ----------------"
+
+        # Merge the agent steps with partial tool results sent while tools run
+        queue: Queue[tuple[str, Any] | None] = Queue()
+        loop = get_running_loop()
+
+        def forward(message: str):
+            if not loop.is_closed():
+                loop.call_soon_threadsafe(queue.put_nowait, ("partial", message))
+
+        async def produce():
+            partial_messages.set(forward)  # Scoped to this task's context
+            try:
+                # Its checkpoints are written once the turn ends, a failed write
+                # is raised by the producer like any other error of the turn
+                async with self.short_term_memory.turn(msg.get("chat_id")):
+                    async for item in self.agent_executor.astream(
+                        new_message, config, stream_mode=["messages", "updates"]
+                    ):
+                        queue.put_nowait(item)
+            finally:
+                queue.put_nowait(None)
+
+        producer = create_task(produce())
+        chunks = []
+        try:
+            while (item := await queue.get()) is not None:
+                kind, chunk = item
+                if kind == "partial":
+                    yield "partial", AgentMessage(**ids, message=chunk)
+                elif kind == "messages":
+                    token, metadata = chunk
+                    # Only the agent's own text, not the tool call arguments
+                    if (
+                        metadata.get("langgraph_node") == "agent"
+                        and isinstance(token, AIMessageChunk)
+                        and isinstance(token.content, str)
+                        and token.content
+                    ):
+                        yield "token", AgentMessage(**ids, message=token.content)
+                else:
+                    for event, message in self.format_chunk(chunk, ids):
+                        if event == "message":
+                            chunks.append(message["message"])
+                        yield event, message
+            await producer
+        finally:
+            producer.cancel()
+        yield "done", AgentMessage(
+            **ids,
+            message="\n".join(chunks).strip().replace("\n\n", "\n"),
+        )
+
+    @staticmethod
+    def format_chunk(
+        chunk: dict, ids: dict
+    ) -> list[tuple[str, AgentMessage | AgentToolEvent]]:
+        messages = []
+        if "agent" in chunk:
+            message = chunk["agent"]["messages"][0]
+            content = message.content.strip()
+            if content:
+                print(
+                    f"---------- AGENT RESPONSE -----------\n{content}\n---------- AGENT END ----------------"
+                )
+                messages.append(("message", AgentMessage(**ids, message=content)))
+            for call in message.tool_calls:
+                messages.append(
+                    (
+                        "tool_start",
+                        AgentToolEvent(
+                            **ids,
+                            tool=call["name"],
+                            call_id=call["id"],
+                            status="started",
+                            args=call["args"],
+                        ),
                     )
-                    yield AgentMessage(
-                        **ids,
-                        message=content,
+                )
+        if "tools" in chunk:
+            # One message per tool call, the calls of a step run together
+            for tool_message in chunk["tools"]["messages"]:
+                messages.append(
+                    (
+                        "tool_end",
+                        AgentToolEvent(
+                            **ids,
+                            tool=tool_message.name,
+                            call_id=tool_message.tool_call_id,
+                            status=tool_message.status,
+                            args=None,
+                        ),
                     )
-            if "tools" in chunk:
-                content = chunk["tools"]["messages"][0].content.strip()
+                )
+                content = tool_message.content.strip()
                 message = content if content.startswith("<tool-") else ""
                 if content:
                     if message:
                         print(
                             f"---------- TOOLS (hidden) ----------\n{content}\n---------- TOOLS END ----------------"
                         )
+                        messages.append(
+                            ("message", AgentMessage(**ids, message=message))
+                        )
                     else:
                         print(
                             f"---------- TOOLS (visible) -----------\n{content}\n---------- TOOLS END ----------------"
                         )
-                    yield AgentMessage(**ids, message=message)
+        return messages
 
     async def chat(self, msg: UserMessage) -> AgentMessage:
-        chunks = []
-        async for message in self.chat_stream(msg):
-            text = message.get("message")
-            if text:
-                chunks.append(text)
-        ids = dict(user_id=msg.get("user_id"), chat_id=msg.get("chat_id"))
-        return AgentMessage(
-            **ids,
-            message="\n".join(chunks).strip().replace("\n\n", "\n"),
-        )
+        # Same run as the stream, only its final answer is kept
+        async for event, message in self.chat_stream(msg):
+            if event == "done":
+                return message
 
 
 async def chat_test(message: str):
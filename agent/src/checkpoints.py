@@ -0,0 +1,369 @@
+from asyncio import Lock, Task, create_task, shield, sleep
+from contextlib import asynccontextmanager, contextmanager, suppress
+from fcntl import LOCK_EX, LOCK_NB, LOCK_UN, flock
+from logging import getLogger
+from os import makedirs, path
+from time import time
+from typing import Any, AsyncIterator, Iterator, Sequence
+
+import coloredlogs
+
+coloredlogs.install()
+logger = getLogger("checkpoints")
+
+from aiosqlite import Connection
+from langchain_core.runnables import RunnableConfig
+from langgraph.checkpoint.base import (
+    WRITES_IDX_MAP,
+    ChannelVersions,
+    Checkpoint,
+    CheckpointMetadata,
+    CheckpointTuple,
+    get_checkpoint_id,
+    get_checkpoint_metadata,
+)
+from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
+
+INSERT_CHECKPOINT = (
+    "INSERT OR REPLACE INTO checkpoints (thread_id, checkpoint_ns, checkpoint_id, "
+    "parent_checkpoint_id, type, checkpoint, metadata) VALUES (?, ?, ?, ?, ?, ?, ?)"
+)
+INSERT_WRITE = (
+    "INSERT OR REPLACE INTO writes (thread_id, checkpoint_ns, checkpoint_id, "
+    "task_id, idx, channel, type, value) VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+)
+
+
+class CheckpointStore(AsyncSqliteSaver):
+    # Chat memory shared by the server processes. The checkpoints of a turn
+    # stay in memory (one per graph step), only the last one is written with
+    # its writes, in one transaction at the end of the turn. The turns of a
+    # chat run one after the other in a process. Each chat keeps
+    # its last checkpoints, idle chats are deleted and the freed pages go back
+    # to the disk in the background
+    def __init__(
+        self,
+        conn: Connection,
+        lock_path: str,
+        keep: int = 2,
+        idle_ttl: float = 30 * 86400,
+        interval: float = 3600,
+    ):
+        super().__init__(conn)
+        self.lock_path = lock_path
+        self.keep = max(1, keep)
+        self.idle_ttl = idle_ttl
+        self.interval = interval
+        self._pending: dict[tuple[str, str], dict[str, Any]] = {}
+        self._turns: dict[str, tuple[Lock, int]] = {}
+        self._prepared = False
+        self._task: Task | None = None
+
+    async def setup(self):
+        if self._prepared:
+            return
+        async with self.lock:
+            if not self.conn.is_alive():
+                await self.conn
+            # Only applies to a new database, compact() converts older ones
+            await self.conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            await self.conn.execute("PRAGMA synchronous=NORMAL")
+        await super().setup()
+        async with self.lock:
+            await self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS checkpoint_threads ("
+                "thread_id TEXT PRIMARY KEY, updated_at REAL NOT NULL)"
+            )
+            await self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS checkpoint_threads_updated_at "
+                "ON checkpoint_threads (updated_at)"
+            )
+            # Chats from before the retention policy start their idle time now
+            await self.conn.execute(
+                "INSERT OR IGNORE INTO checkpoint_threads (thread_id, updated_at) "
+                "SELECT DISTINCT thread_id, ? FROM checkpoints",
+                (time(),),
+            )
+            await self.conn.commit()
+        self._prepared = True
+
+    async def start(self):
+        if self._task is None:
+            self._task = create_task(self._compact_forever())
+            logger.info(
+                f"Checkpoints: ready (last {self.keep} per chat, "
+                f"idle chats kept {self.idle_ttl / 86400:g} days)"
+            )
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            with suppress(BaseException):
+                await self._task
+            self._task = None
+        for thread_id in {thread_id for thread_id, _ in self._pending}:
+            await self.flush(thread_id)
+        await self.conn.close()
+        logger.info("Checkpoints: closed")
+
+    async def aget_tuple(self, config: RunnableConfig) -> CheckpointTuple | None:
+        # A turn still running reads its own checkpoints
+        turn = self._pending.get(
+            (
+                str(config["configurable"]["thread_id"]),
+                config["configurable"].get("checkpoint_ns", ""),
+            )
+        )
+        if turn is None or get_checkpoint_id(config) not in (None, turn["id"]):
+            return await super().aget_tuple(config)
+        (
+            thread_id,
+            checkpoint_ns,
+            checkpoint_id,
+            parent_id,
+            type_,
+            checkpoint,
+            metadata,
+        ) = turn["checkpoint"]
+        return CheckpointTuple(
+            dict(
+                configurable=dict(
+                    thread_id=thread_id,
+                    checkpoint_ns=checkpoint_ns,
+                    checkpoint_id=checkpoint_id,
+                )
+            ),
+            self.serde.loads_typed((type_, checkpoint)),
+            self.jsonplus_serde.loads(metadata),
+            (
+                dict(
+                    configurable=dict(
+                        thread_id=thread_id,
+                        checkpoint_ns=checkpoint_ns,
+                        checkpoint_id=parent_id,
+                    )
+                )
+                if parent_id
+                else None
+            ),
+            [
+                (task_id, channel, self.serde.loads_typed((write_type, value)))
+                for (*_, task_id, _, channel, write_type, value) in sorted(
+                    turn["writes"].values(), key=lambda write: write[3:5]
+                )
+            ],
+        )
+
+    async def aput(
+        self,
+        config: RunnableConfig,
+        checkpoint: Checkpoint,
+        metadata: CheckpointMetadata,
+        new_versions: ChannelVersions,
+    ) -> RunnableConfig:
+        thread_id = str(config["configurable"]["thread_id"])
+        checkpoint_ns = config["configurable"]["checkpoint_ns"]
+        # Written later, the parent is the last checkpoint written before the turn
+        turn = self._pending.setdefault(
+            (thread_id, checkpoint_ns),
+            dict(parent_id=config["configurable"].get("checkpoint_id")),
+        )
+        turn.update(
+            id=checkpoint["id"],
+            checkpoint=(
+                thread_id,
+                checkpoint_ns,
+                checkpoint["id"],
+                turn["parent_id"],
+                *self.serde.dumps_typed(checkpoint),
+                self.jsonplus_serde.dumps(get_checkpoint_metadata(config, metadata)),
+            ),
+            writes={},
+        )
+        return dict(
+            configurable=dict(
+                thread_id=thread_id,
+                checkpoint_ns=checkpoint_ns,
+                checkpoint_id=checkpoint["id"],
+            )
+        )
+
+    async def aput_writes(
+        self,
+        config: RunnableConfig,
+        writes: Sequence[tuple[str, Any]],
+        task_id: str,
+        task_path: str = "",
+    ):
+        thread_id = str(config["configurable"]["thread_id"])
+        checkpoint_ns = str(config["configurable"]["checkpoint_ns"])
+        checkpoint_id = str(config["configurable"]["checkpoint_id"])
+        turn = self._pending.get((thread_id, checkpoint_ns))
+        if turn is None or turn["id"] != checkpoint_id:
+            return await super().aput_writes(config, writes, task_id, task_path)
+        # Same rules as the saver: special channels replace, the others are kept
+        replace = all(channel in WRITES_IDX_MAP for channel, _ in writes)
+        for idx, (channel, value) in enumerate(writes):
+            idx = WRITES_IDX_MAP.get(channel, idx)
+            if replace or (task_id, idx) not in turn["writes"]:
+                turn["writes"][(task_id, idx)] = (
+                    thread_id,
+                    checkpoint_ns,
+                    checkpoint_id,
+                    task_id,
+                    idx,
+                    channel,
+                    *self.serde.dumps_typed(value),
+                )
+
+    @asynccontextmanager
+    async def turn(self, thread_id: str) -> AsyncIterator[None]:
+        # Runs a chat turn, after the one still running for the same chat
+        thread_id = str(thread_id)
+        lock, users = self._turns.get(thread_id, (Lock(), 0))
+        self._turns[thread_id] = (lock, users + 1)
+        try:
+            async with lock:
+                try:
+                    yield
+                finally:
+                    await self.flush(thread_id)
+        finally:
+            lock, users = self._turns[thread_id]
+            if users > 1:
+                self._turns[thread_id] = (lock, users - 1)
+            else:
+                del self._turns[thread_id]
+
+    async def flush(self, thread_id: str):
+        # End of a chat turn, shielded so a closed stream can't cut it halfway
+        await shield(self._flush(str(thread_id)))
+
+    async def _flush(self, thread_id: str):
+        keys = [key for key in self._pending if key[0] == thread_id]
+        if not keys:
+            return
+        await self.setup()
+        async with self.lock:
+            turns = [(key, self._pending.pop(key, None)) for key in keys]
+            turns = [(key, turn) for key, turn in turns if turn is not None]
+            try:
+                for (_, checkpoint_ns), turn in turns:
+                    await self.conn.execute(INSERT_CHECKPOINT, turn["checkpoint"])
+                    await self.conn.executemany(INSERT_WRITE, turn["writes"].values())
+                    await self._prune(thread_id, checkpoint_ns)
+                await self.conn.execute(
+                    "INSERT OR REPLACE INTO checkpoint_threads (thread_id, updated_at) "
+                    "VALUES (?, ?)",
+                    (thread_id, time()),
+                )
+                await self.conn.commit()
+            except BaseException:
+                await self.conn.rollback()
+                raise
+
+    async def _prune(self, thread_id: str, checkpoint_ns: str) -> int:
+        # Checkpoints older than the last ones kept, with their writes. Ids are
+        # time ordered. The caller holds the lock and commits
+        async with self.conn.execute(
+            "SELECT checkpoint_id FROM checkpoints "
+            "WHERE thread_id = ? AND checkpoint_ns = ? "
+            "ORDER BY checkpoint_id DESC LIMIT 1 OFFSET ?",
+            (thread_id, checkpoint_ns, self.keep - 1),
+        ) as cursor:
+            row = await cursor.fetchone()
+        if row is None:
+            return 0
+        params = (thread_id, checkpoint_ns, row[0])
+        cursor = await self.conn.execute(
+            "DELETE FROM checkpoints "
+            "WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id < ?",
+            params,
+        )
+        await self.conn.execute(
+            "DELETE FROM writes "
+            "WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id < ?",
+            params,
+        )
+        return cursor.rowcount
+
+    @contextmanager
+    def _exclusive(self) -> Iterator[bool]:
+        # One compacting process at a time, the others skip their round
+        makedirs(path.dirname(self.lock_path), exist_ok=True)
+        with open(self.lock_path, "w") as lock:
+            try:
+                flock(lock, LOCK_EX | LOCK_NB)
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                flock(lock, LOCK_UN)
+
+    async def _compact_forever(self):
+        while True:
+            try:
+                await self.compact()
+            except Exception as e:
+                logger.error(f"Checkpoints compaction failed: {e!r}")
+            await sleep(self.interval)
+
+    async def compact(self) -> tuple[int, int]:
+        # Returns the idle chats and old checkpoints deleted. One chat per
+        # transaction, the turns being written get the database in between
+        await self.setup()
+        with self._exclusive() as acquired:
+            if not acquired:
+                return 0, 0
+            async with self.lock, self.conn.execute(
+                "SELECT thread_id FROM checkpoint_threads WHERE updated_at < ?",
+                (time() - self.idle_ttl,),
+            ) as cursor:
+                idle = [row[0] for row in await cursor.fetchall()]
+            for thread_id in idle:
+                async with self.lock:
+                    for table in ("writes", "checkpoints", "checkpoint_threads"):
+                        await self.conn.execute(
+                            f"DELETE FROM {table} WHERE thread_id = ?", (thread_id,)
+                        )
+                    await self.conn.commit()
+
+            # Only chats from before the retention policy, the turns prune theirs
+            async with self.lock, self.conn.execute(
+                "SELECT thread_id, checkpoint_ns FROM checkpoints "
+                "GROUP BY thread_id, checkpoint_ns HAVING COUNT(*) > ?",
+                (self.keep,),
+            ) as cursor:
+                crowded = await cursor.fetchall()
+            pruned = 0
+            for thread_id, checkpoint_ns in crowded:
+                async with self.lock:
+                    pruned += await self._prune(thread_id, checkpoint_ns)
+                    await self.conn.commit()
+
+            async with self.lock:
+                await self._vacuum()
+        if idle or pruned:
+            logger.info(
+                f"Checkpoints: deleted {len(idle)} idle chat(s) "
+                f"and {pruned} old checkpoint(s)"
+            )
+        return len(idle), pruned
+
+    async def _vacuum(self):
+        async with self.conn.execute("PRAGMA auto_vacuum") as cursor:
+            (auto_vacuum,) = await cursor.fetchone()
+        if auto_vacuum != 2:
+            # Databases created before, rewritten once to free pages from now on
+            logger.info("Checkpoints: converting the database to incremental vacuum")
+            await self.conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            await self.conn.execute("VACUUM")
+        else:
+            # Frees a page per row returned, all of them once read
+            async with self.conn.execute("PRAGMA incremental_vacuum") as cursor:
+                await cursor.fetchall()
+        # The WAL only grows while the other processes keep reading
+        async with self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)") as cursor:
+            await cursor.fetchall()
@@ -11,3 +11,50 @@ class AgentMessage(JSONResponse):
     user_id: str
     chat_id: str
     message: str
+
+
+class AgentToolEvent(JSONResponse):
+    user_id: str
+    chat_id: str
+    tool: str
+    call_id: str
+    status: str
+    args: dict | None
+
+
+class JobStatus(JSONResponse):
+    id: str
+    status: str
+    filename: str
+    magnet_link: str
+    infohash: str | None
+    target: str | None
+    progress: dict | None
+    result: dict | None
+    error: str | None
+    pid: int | None
+    created_at: float
+    updated_at: float
+
+
+class StorageMetrics(JSONResponse):
+    disk_total: int
+    disk_used: int
+    disk_free: int
+    disk_usage: float
+    high_watermark: float
+    low_watermark: float
+    indexed_entries: int
+    indexed_bytes: int
+    evictions: int
+    freed_bytes: int
+    last_eviction_at: float | None
+    runs: int
+    errors: int
+    last_run_at: float | None
+
+
+class ReadinessReport(JSONResponse):
+    ready: bool
+    uptime: float
+    subsystems: dict
@@ -0,0 +1,85 @@
+from asyncio import Event, Task, create_task, gather, wait_for
+from inspect import isawaitable
+from logging import getLogger
+from time import perf_counter, time
+from typing import Any, Callable
+
+import coloredlogs
+
+coloredlogs.install()
+logger = getLogger("readiness")
+
+
+class Readiness:
+    # Subsystems start in the background once the server listens, each one
+    # reports its own state so a slow or broken one doesn't hold the others
+    def __init__(self):
+        self.started_at = time()
+        self._subsystems: dict[str, dict[str, Any]] = {}
+        self._events: dict[str, Event] = {}
+        self._tasks: dict[str, Task] = {}
+
+    def start(self, name: str, step: Callable[[], Any], after: tuple[str, ...] = ()):
+        # The step starts once the subsystems it needs are ready
+        self._subsystems[name] = dict(status="starting", seconds=None, error=None)
+        self._events[name] = Event()
+        self._tasks[name] = create_task(self._run(name, step, after))
+
+    async def _run(self, name: str, step: Callable[[], Any], after: tuple[str, ...]):
+        for dependency in after:
+            if not await self.wait(dependency):
+                self._subsystems[name].update(
+                    status="failed", error=f"{dependency} is not ready"
+                )
+                self._events[name].set()
+                logger.error(f"{name}: not started, {dependency} is not ready")
+                return
+        start = perf_counter()
+        try:
+            result = step()
+            if isawaitable(result):
+                await result
+        except Exception as e:
+            self._subsystems[name].update(status="failed", error=str(e))
+            logger.error(f"{name}: failed to start ({e})")
+        else:
+            self._subsystems[name]["status"] = "ready"
+        finally:
+            self._subsystems[name]["seconds"] = round(perf_counter() - start, 3)
+            self._events[name].set()
+        if self._subsystems[name]["status"] == "ready":
+            logger.info(f"{name}: started in {self._subsystems[name]['seconds']}s")
+        if self.ready:
+            logger.info(f"Ready in {time() - self.started_at:.2f}s")
+
+    @property
+    def ready(self) -> bool:
+        return all(
+            subsystem["status"] == "ready" for subsystem in self._subsystems.values()
+        )
+
+    async def wait(self, name: str, timeout: float | None = None) -> bool:
+        # True once the subsystem is up, False if it failed or is still starting
+        if name not in self._events:
+            return False
+        try:
+            await wait_for(self._events[name].wait(), timeout)
+        except TimeoutError:
+            return False
+        return self._subsystems[name]["status"] == "ready"
+
+    async def join(self):
+        await gather(*self._tasks.values(), return_exceptions=True)
+
+    async def cancel(self):
+        # Shutdown before the end of the startup
+        for task in self._tasks.values():
+            task.cancel()
+        await self.join()
+
+    def report(self) -> dict[str, Any]:
+        return dict(
+            ready=self.ready,
+            uptime=round(time() - self.started_at, 3),
+            subsystems={name: dict(state) for name, state in self._subsystems.items()},
+        )
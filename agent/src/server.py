@@ -1,4 +1,6 @@
+from json import dumps
 from logging import getLogger
+from os import getenv
 
 import coloredlogs
 from dotenv import load_dotenv
@@ -7,14 +9,42 @@ load_dotenv()
 coloredlogs.install()
 logger = getLogger("server")
 
-from robyn import ALLOW_CORS, Request, Response, Robyn
+from robyn import (
+    ALLOW_CORS,
+    Headers,
+    Request,
+    Response,
+    Robyn,
+    SSEMessage,
+    SSEResponse,
+    StreamingResponse,
+)
 from robyn.openapi import Components, OpenAPI, OpenAPIInfo
-from robyn.status_codes import HTTP_200_OK, HTTP_500_INTERNAL_SERVER_ERROR
+from robyn.status_codes import (
+    HTTP_200_OK,
+    HTTP_404_NOT_FOUND,
+    HTTP_500_INTERNAL_SERVER_ERROR,
+    HTTP_503_SERVICE_UNAVAILABLE,
+)
 
 from agentkit import Agent
-from models import UserMessage
+from models import JobStatus, ReadinessReport, StorageMetrics, UserMessage
+from readiness import Readiness
+from tools import (
+    StreamError,
+    browser_pool,
+    cid_hasher,
+    download_jobs,
+    eviction_manager,
+    file_streamer,
+    http_pool,
+    ipfs_pool,
+    torrent_client,
+)
 
 agent = Agent()
+readiness = Readiness()
+AGENT_STARTUP_TIMEOUT = float(getenv("AGENT_STARTUP_TIMEOUT", "60"))
 
 app = Robyn(
     __file__,
@@ -31,12 +61,34 @@ ALLOW_CORS(app, origins=["*"])
 
 
 async def startup():
+    # Requests are served meanwhile, see /v1/ready
     logger.info("Starting up...")
-    await agent.init()
-    logger.info("Ready!")
+    readiness.start("agent", agent.init)
+    readiness.start("browser", browser_pool.start)
+    readiness.start("http", http_pool.start)
+    readiness.start("ipfs", ipfs_pool.start)
+    readiness.start("torrents", torrent_client.start)
+    # Recovered jobs resume their downloads right away
+    readiness.start("jobs", download_jobs.start, after=("ipfs", "torrents"))
+    readiness.start("eviction", eviction_manager.start)
+
+
+async def shutdown():
+    logger.info("Shutting down...")
+    await readiness.cancel()
+    await agent.close()
+    await browser_pool.close()
+    await http_pool.close()
+    await eviction_manager.close()
+    await download_jobs.close()
+    torrent_client.close()
+    cid_hasher.close()
+    await ipfs_pool.close()
+    logger.info("Stopped!")
 
 
 app.startup_handler(startup)
+app.shutdown_handler(shutdown)
 
 
 @app.before_request()
@@ -51,12 +103,37 @@ async def log_response(response: Response):
     return response
 
 
+async def agent_unavailable() -> Response | None:
+    # Chats wait for the agent while the server starts
+    if await readiness.wait("agent", timeout=AGENT_STARTUP_TIMEOUT):
+        return None
+    return Response(
+        status_code=HTTP_503_SERVICE_UNAVAILABLE,
+        headers={"Retry-After": "5"},
+        description="Agent unavailable, see /v1/ready",
+    )
+
+
+@app.get("/v1/ready")
+async def ready() -> ReadinessReport:
+    report = readiness.report()
+    if report["ready"]:
+        return report
+    return Response(
+        status_code=HTTP_503_SERVICE_UNAVAILABLE,
+        headers={"Content-Type": "application/json"},
+        description=dumps(report),
+    )
+
+
 @app.options("/v1/chat")
 @app.post("/v1/chat")
 async def chat(request: Request, _: UserMessage):
     try:
         if request.method == "OPTIONS":
             return Response(status_code=HTTP_200_OK, headers={}, description="OK")
+        if unavailable := await agent_unavailable():
+            return unavailable
         return await agent.chat(request.json())
     except Exception as e:
         logger.error(f"Error in chat: {str(e)}")
@@ -73,8 +150,9 @@ async def chat_stream(request: Request, _: UserMessage):
     try:
         if request.method == "OPTIONS":
             return Response(status_code=HTTP_200_OK, headers={}, description="OK")
-        # TODO
-        return await agent.chat_stream(request.json())
+        if unavailable := await agent_unavailable():
+            return unavailable
+        message = request.json()
     except Exception as e:
         logger.error(f"Error in chat stream: {str(e)}")
         return Response(
@@ -83,6 +161,77 @@ async def chat_stream(request: Request, _: UserMessage):
             description=f"Error in chat stream: {str(e)}",
         )
 
+    async def events():
+        # Tokens as they are generated, the last event is the whole answer
+        try:
+            async for event, payload in agent.chat_stream(message):
+                yield SSEMessage(dumps(payload), event=event)
+        except Exception as e:
+            # Headers are already sent, the error ends the stream instead
+            logger.error(f"Error in chat stream: {str(e)}")
+            yield SSEMessage(dumps(dict(error=str(e))), event="error")
+
+    return SSEResponse(events())
+
+
+@app.get("/v1/jobs/:job_id")
+async def job_status(request: Request) -> JobStatus:
+    job = await download_jobs.get(request.path_params["job_id"])
+    if job is None:
+        return Response(
+            status_code=HTTP_404_NOT_FOUND, headers={}, description="Job not found"
+        )
+    return job
+
+
+@app.get("/v1/jobs/:job_id/stream")
+async def job_stream(request: Request):
+    job_id = request.path_params["job_id"]
+    if await download_jobs.get(job_id) is None:
+        return Response(
+            status_code=HTTP_404_NOT_FOUND, headers={}, description="Job not found"
+        )
+
+    async def events():
+        # One event per progress update, the last one carries the final status
+        async for job in download_jobs.watch(job_id):
+            yield SSEMessage(dumps(job), event=job["status"], id=str(job["updated_at"]))
+
+    return SSEResponse(events())
+
+
+@app.get("/v1/jobs/:job_id/file")
+async def job_file(request: Request):
+    # Signed links handed out with the job, range requests let players seek
+    try:
+        status_code, headers, chunks = await file_streamer.open(
+            request.path_params["job_id"],
+            request.query_params.get("token", ""),
+            request.query_params.get("file", None),
+            request.headers.get("range"),
+        )
+        if status_code == 206:
+            # Robyn streams without a Content-Length, bounded ranges are sent whole
+            headers, body = await file_streamer.read_range(headers, chunks)
+            return Response(
+                status_code=status_code, headers=Headers(headers), description=body
+            )
+    except StreamError as e:
+        return Response(
+            status_code=e.status_code, headers=e.headers, description=e.message
+        )
+    return StreamingResponse(
+        chunks,
+        status_code=status_code,
+        headers=Headers(headers),
+        media_type=headers["Content-Type"],
+    )
+
+
+@app.get("/v1/metrics/storage")
+async def storage_metrics() -> StorageMetrics:
+    return await eviction_manager.metrics()
+
 
 if __name__ == "__main__":
     app.start(host="0.0.0.0", port=1789)
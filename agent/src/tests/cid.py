@@ -0,0 +1,81 @@
+import sys
+from asyncio import run
+from os import cpu_count, path
+from pathlib import Path
+from time import perf_counter
+
+sys.path.append(str(Path(__file__).parent.parent.parent))
+
+from rich import print as pr
+from rich.console import Console
+from rich.table import Table
+from src.tools.cid import CidHasher, cid_hasher, file_cid
+from src.tools.ipfs import IpfsError, ipfs_pool
+
+
+async def kubo_cid(file_path: str) -> str | None:
+    # Same DAG options as the downloads, without storing anything
+    try:
+        files = await ipfs_pool.add(
+            file_path, only_hash=True, quieter=True, **cid_hasher.add_options
+        )
+    except IpfsError as e:
+        pr(f"[red]kubo unavailable: {e}[/red]")
+        return None
+    return list(files.values())[-1]
+
+
+async def benchmark(file_paths: list[str], workers: int):
+    hasher = CidHasher(workers=workers)
+    table = Table(title=f"CID computation ({workers} workers)")
+    table.add_column("File", style="magenta")
+    table.add_column("Size", justify="right", style="green")
+    table.add_column("Hash path")
+    table.add_column("Time (s)", justify="right", style="yellow")
+    table.add_column("MB/s", justify="right", style="yellow")
+    table.add_column("CID", style="cyan", overflow="fold")
+    table.add_column("Same as kubo", justify="center")
+
+    for file_path in file_paths:
+        size = path.getsize(file_path)
+        timings = {}
+        # kubo reads first, the local paths then hash from the page cache
+        start = perf_counter()
+        kubo = await kubo_cid(file_path)
+        if kubo:
+            timings["kubo --only-hash"] = (perf_counter() - start, kubo)
+        start = perf_counter()
+        cid = file_cid(file_path)
+        timings["local, 1 process"] = (perf_counter() - start, cid)
+        start = perf_counter()
+        cid = await hasher.cid(file_path)
+        timings[f"local, pool of {workers}"] = (perf_counter() - start, cid)
+        for name, (seconds, cid) in timings.items():
+            table.add_row(
+                path.basename(file_path),
+                f"{size / 1024**2:.1f} MB",
+                name,
+                f"{seconds:.2f}",
+                f"{size / 1024**2 / seconds:.0f}" if seconds else "-",
+                cid or "-",
+                (
+                    "-"
+                    if kubo is None
+                    else "[green]yes[/green]" if cid == kubo else "[red]NO[/red]"
+                ),
+            )
+    hasher.close()
+    await ipfs_pool.close()
+    Console().print(table)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        pr("Usage: python src/tests/cid.py <file>... [--workers N]")
+        exit(1)
+    args, workers = sys.argv[1:], cpu_count() or 2
+    if "--workers" in args:
+        index = args.index("--workers")
+        workers = int(args[index + 1])
+        args = args[:index] + args[index + 2 :]
+    run(benchmark(args, workers))
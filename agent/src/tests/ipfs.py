@@ -28,7 +28,7 @@ async def add_to_ipfs(
         async with client as ipfs:
             logger.info(f"Adding file: {file_path}")
             async for added in ipfs.add(
-                file_path, pin=True, recursive=True, quieter=True, no_copy=True
+                file_path, pin=True, recursive=True, quieter=True, nocopy=True
             ):
                 curr_hash, curr_name = added["Hash"], added["Name"]
                 files[curr_name] = curr_hash
@@ -0,0 +1,111 @@
+import sys
+from asyncio import run
+from pathlib import Path
+from time import perf_counter
+from urllib.parse import quote
+
+sys.path.append(str(Path(__file__).parent.parent.parent))
+
+from rich import print as pr
+from rich.console import Console
+from rich.table import Table
+from src.tools.fetcher import process_html
+from src.tools.scraper import (
+    PIPELINES,
+    WEBSITES,
+    browser_pool,
+    crawl_source,
+    crawler_run_config,
+    extract_via_csv,
+    http_pool,
+    parse_torrents,
+    shrink_text,
+)
+
+FIXTURES_DIR = Path(__file__).parent / "fixtures" / "parsers"
+
+
+async def record(query: str):
+    FIXTURES_DIR.mkdir(parents=True, exist_ok=True)
+    for source, data in WEBSITES.items():
+        url = data["search"].format(query=quote(query))
+        result = await crawl_source(url, data)
+        fixture = FIXTURES_DIR / f"{source}__{quote(query, safe='')}.html"
+        fixture.write_text(result.html, encoding="utf-8")
+        pr(f"Recorded {fixture.name} ({len(result.html)} chars)")
+    await http_pool.close()
+    await browser_pool.close()
+
+
+def via_csv(source: str, url: str, html: str) -> list[dict]:
+    # Legacy path: crawl4ai markdown/cleaned html -> regex pipeline -> CSV
+    crawl_result = process_html(url, html, crawler_run_config())
+    text = shrink_text(
+        (
+            crawl_result.cleaned_html
+            if WEBSITES[source]["parsing"] == "html"
+            else crawl_result.markdown
+        ),
+        PIPELINES[source],
+    )
+    return extract_via_csv(f"SCRAPING WEBSITE SOURCE -> {source}:\n{text}")
+
+
+def timeit(func, rounds: int) -> float:
+    start = perf_counter()
+    for _ in range(rounds):
+        func()
+    return (perf_counter() - start) / rounds * 1000
+
+
+def benchmark(rounds: int = 20):
+    fixtures = sorted(FIXTURES_DIR.glob("*.html"))
+    if not fixtures:
+        pr(
+            "No fixture found, record some with: python src/tests/parsers.py record <search>"
+        )
+        exit(1)
+
+    table = Table(title=f"HTML -> torrents ({rounds} rounds)")
+    table.add_column("Fixture", style="magenta")
+    table.add_column("Input", justify="right", style="green")
+    table.add_column("CSV (ms)", justify="right", style="yellow")
+    table.add_column("DOM (ms)", justify="right", style="yellow")
+    table.add_column("Speedup", justify="right", style="cyan")
+    table.add_column("Torrents (CSV/DOM)", justify="right", style="green")
+    table.add_column("Same magnets", justify="right")
+
+    for fixture in fixtures:
+        source = fixture.name.split("__", 1)[0]
+        data = WEBSITES[source]
+        url = data["search"].format(query=fixture.stem.split("__", 1)[1])
+        html = fixture.read_text(encoding="utf-8")
+        csv_torrents = via_csv(source, url, html)
+        dom_torrents = parse_torrents(source, data, html) or []
+        same = {torrent.get("magnet_link") for torrent in csv_torrents} & {
+            torrent["magnet_link"] for torrent in dom_torrents
+        }
+        csv_ms = timeit(lambda: via_csv(source, url, html), rounds)
+        dom_ms = timeit(lambda: parse_torrents(source, data, html), rounds)
+        table.add_row(
+            fixture.name,
+            f"{len(html) / 1000:.1f} KB",
+            f"{csv_ms:.2f}",
+            f"{dom_ms:.2f}",
+            f"x{csv_ms / dom_ms:.1f}",
+            f"{len(csv_torrents)}/{len(dom_torrents)}",
+            str(len(same)),
+        )
+    Console().print(table)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2 and sys.argv[1] == "record":
+        run(record(" ".join(sys.argv[2:])))
+    elif len(sys.argv) > 1 and sys.argv[1] != "record":
+        benchmark(int(sys.argv[1]))
+    elif len(sys.argv) == 1:
+        benchmark()
+    else:
+        pr("Usage: python src/tests/parsers.py [rounds] | record <search>")
+        exit(1)
@@ -0,0 +1,113 @@
+import re
+import sys
+from asyncio import run
+from pathlib import Path
+from time import perf_counter
+from urllib.parse import quote
+
+sys.path.append(str(Path(__file__).parent.parent.parent))
+
+from rich import print as pr
+from rich.console import Console
+from rich.table import Table
+from src.tools.scraper import (
+    FILTERS,
+    PIPELINES,
+    REPLACERS,
+    WEBSITES,
+    browser_pool,
+    crawler_run_config,
+    shrink_text,
+)
+
+FIXTURES_DIR = Path(__file__).parent / "fixtures" / "shrink"
+
+
+def legacy_shrink_text(
+    text: str, exclude_patterns: list[str] | None = None, max_chars=5000
+) -> str:
+    # Reference implementation: one full-string pass per pattern
+    text = text.split("<li>", 1)[-1].replace("<li>", "")
+    for name, pattern in FILTERS.items():
+        if exclude_patterns and name in exclude_patterns:
+            continue
+        text = pattern.sub("", text)
+    for name, replacer_config in REPLACERS.items():
+        if exclude_patterns and name in exclude_patterns:
+            continue
+        pattern, replacement_str = replacer_config
+        text = pattern.sub(replacement_str, text)
+    if len(text) > max_chars:
+        safe_truncate_pos = text.rfind("\n", 0, max_chars)
+        if safe_truncate_pos == -1:
+            text = text[:max_chars]
+        else:
+            text = text[:safe_truncate_pos]
+    text = re.sub(r"\n{2,}", "\n", text)
+    return text.strip()
+
+
+async def record(query: str):
+    FIXTURES_DIR.mkdir(parents=True, exist_ok=True)
+    for source, data in WEBSITES.items():
+        url = data["search"].format(query=quote(query))
+        result = await browser_pool.crawl(url=url, config=crawler_run_config())
+        text = result.cleaned_html if data["parsing"] == "html" else result.markdown
+        fixture = FIXTURES_DIR / f"{source}__{quote(query, safe='')}.txt"
+        fixture.write_text(text, encoding="utf-8")
+        pr(f"Recorded {fixture.name} ({len(text)} chars)")
+    await browser_pool.close()
+
+
+def timeit(func, rounds: int) -> float:
+    start = perf_counter()
+    for _ in range(rounds):
+        func()
+    return (perf_counter() - start) / rounds * 1000
+
+
+def benchmark(rounds: int = 20):
+    fixtures = sorted(FIXTURES_DIR.glob("*.txt"))
+    if not fixtures:
+        pr(
+            "No fixture found, record some with: python src/tests/shrink.py record <search>"
+        )
+        exit(1)
+
+    table = Table(title=f"shrink_text ({rounds} rounds)")
+    table.add_column("Fixture", style="magenta")
+    table.add_column("Input", justify="right", style="green")
+    table.add_column("Legacy (ms)", justify="right", style="yellow")
+    table.add_column("Pipeline (ms)", justify="right", style="yellow")
+    table.add_column("Speedup", justify="right", style="cyan")
+    table.add_column("Identical", justify="center")
+
+    for fixture in fixtures:
+        source = fixture.name.split("__", 1)[0]
+        text = fixture.read_text(encoding="utf-8")
+        exclude_patterns = WEBSITES[source].get("exclude_patterns", [])
+        legacy = legacy_shrink_text(text, exclude_patterns)
+        identical = legacy == shrink_text(text, PIPELINES[source])
+        legacy_ms = timeit(lambda: legacy_shrink_text(text, exclude_patterns), rounds)
+        pipeline_ms = timeit(lambda: shrink_text(text, PIPELINES[source]), rounds)
+        table.add_row(
+            fixture.name,
+            f"{len(text) / 1000:.1f} KB",
+            f"{legacy_ms:.2f}",
+            f"{pipeline_ms:.2f}",
+            f"x{legacy_ms / pipeline_ms:.1f}",
+            "[green]yes[/green]" if identical else "[red]NO[/red]",
+        )
+    Console().print(table)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2 and sys.argv[1] == "record":
+        run(record(" ".join(sys.argv[2:])))
+    elif len(sys.argv) > 1 and sys.argv[1] != "record":
+        benchmark(int(sys.argv[1]))
+    elif len(sys.argv) == 1:
+        benchmark()
+    else:
+        pr("Usage: python src/tests/shrink.py [rounds] | record <search>")
+        exit(1)
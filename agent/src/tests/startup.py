@@ -0,0 +1,123 @@
+import sys
+from asyncio import run
+from json import dumps, loads
+from pathlib import Path
+from subprocess import run as run_process
+from time import perf_counter
+
+# Ahead of this folder, its scripts would shadow the server modules
+SRC_DIR = Path(__file__).parent.parent
+sys.path.insert(0, str(SRC_DIR))
+
+from rich import print as pr
+from rich.console import Console
+from rich.table import Table
+
+# Server modules, then the heavy dependencies they load
+MODULES = [
+    "server",
+    "agentkit",
+    "tools",
+    "crawl4ai",
+    "openai",
+    "langchain_openai",
+    "langgraph.prebuilt",
+    "langgraph.checkpoint.sqlite.aio",
+    "coinbase_agentkit",
+    "libtorrent",
+    "aioipfs",
+]
+IMPORT_SCRIPT = (
+    "from time import perf_counter; start = perf_counter(); import {module}; "
+    "print(perf_counter() - start)"
+)
+LOADED_SCRIPT = (
+    "import sys, json, server; "
+    "print(json.dumps([module for module in {modules} if module in sys.modules]))"
+)
+
+
+def python(script: str) -> str | None:
+    # Fresh interpreter each time, nothing already imported
+    process = run_process(
+        [sys.executable, "-c", script], cwd=SRC_DIR, capture_output=True, text=True
+    )
+    if process.returncode:
+        pr(f"[red]{process.stderr.strip().splitlines()[-1]}[/red]")
+        return None
+    return process.stdout.strip().splitlines()[-1]
+
+
+def import_seconds(module: str, runs: int) -> float | None:
+    seconds = [python(IMPORT_SCRIPT.format(module=module)) for _ in range(runs)]
+    if None in seconds:
+        return None
+    return min(float(second) for second in seconds)
+
+
+def benchmark_imports(runs: int):
+    loaded = loads(python(LOADED_SCRIPT.format(modules=dumps(MODULES))) or "[]")
+    table = Table(title=f"Imports (best of {runs}, fresh interpreters)")
+    table.add_column("Module", style="magenta")
+    table.add_column("Time (s)", justify="right", style="yellow")
+    table.add_column("Loaded by the server", justify="center")
+    for module in MODULES:
+        seconds = import_seconds(module, runs)
+        table.add_row(
+            module,
+            "-" if seconds is None else f"{seconds:.3f}",
+            (
+                "-"
+                if module == "server"
+                else "[red]at import[/red]" if module in loaded else "on first use"
+            ),
+        )
+    Console().print(table)
+
+
+async def benchmark_init():
+    start = perf_counter()
+    import server
+
+    imported = perf_counter() - start
+    start = perf_counter()
+    await server.startup()
+    listening = perf_counter() - start
+    await server.readiness.join()
+    ready = perf_counter() - start
+    report = server.readiness.report()
+    await server.shutdown()
+
+    table = Table(title="Subsystems init (in this process)")
+    table.add_column("Subsystem", style="magenta")
+    table.add_column("Status")
+    table.add_column("Time (s)", justify="right", style="yellow")
+    table.add_column("Error", style="red", overflow="fold")
+    table.add_row("import server", "", f"{imported:.3f}", "")
+    table.add_row("startup handler", "", f"{listening:.3f}", "")
+    for name, subsystem in report["subsystems"].items():
+        table.add_row(
+            name,
+            (
+                "[green]ready[/green]"
+                if subsystem["status"] == "ready"
+                else f"[red]{subsystem['status']}[/red]"
+            ),
+            "-" if subsystem["seconds"] is None else f"{subsystem['seconds']:.3f}",
+            subsystem["error"] or "",
+        )
+    Console().print(table)
+    # Subsystems start together, the slowest one sets the readiness
+    pr(f"All ready: {report['ready']}, {ready:.3f}s after startup")
+
+
+if __name__ == "__main__":
+    args, runs = sys.argv[1:], 3
+    if "--runs" in args:
+        index = args.index("--runs")
+        runs = int(args[index + 1])
+        args = args[:index] + args[index + 2 :]
+    benchmark_imports(runs)
+    if "--no-init" not in args:
+        # Starts every subsystem for real: wallet, LLM, browsers, IPFS, torrents
+        run(benchmark_init())
@@ -1,4 +1,36 @@
-from .downloader import downloader_action_provider
-from .scraper import find_torrent_list, scraper_action_provider
+from .cid import cid_hasher
+from .downloader import (
+    download_jobs,
+    downloader_action_provider,
+    eviction_manager,
+    file_streamer,
+    torrent_client,
+)
+from .ipfs import ipfs_pool
+from .partials import is_partial, partial_messages
+from .scraper import (
+    browser_pool,
+    find_torrent_list,
+    http_pool,
+    scraper_action_provider,
+    stream_torrent_list,
+)
+from .streaming import StreamError
 
-__all__ = ["scraper_action_provider", "find_torrent_list", "downloader_action_provider"]
+__all__ = [
+    "scraper_action_provider",
+    "find_torrent_list",
+    "stream_torrent_list",
+    "browser_pool",
+    "http_pool",
+    "downloader_action_provider",
+    "download_jobs",
+    "torrent_client",
+    "eviction_manager",
+    "file_streamer",
+    "ipfs_pool",
+    "cid_hasher",
+    "partial_messages",
+    "is_partial",
+    "StreamError",
+]
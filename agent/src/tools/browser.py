@@ -0,0 +1,151 @@
+from __future__ import annotations
+
+from asyncio import (
+    AbstractEventLoop,
+    Lock,
+    Queue,
+    Task,
+    create_task,
+    gather,
+    get_running_loop,
+    to_thread,
+)
+from contextlib import asynccontextmanager
+from logging import getLogger
+from typing import TYPE_CHECKING, AsyncIterator, Callable
+
+import coloredlogs
+
+coloredlogs.install()
+logger = getLogger("browser")
+
+if TYPE_CHECKING:
+    from crawl4ai import AsyncWebCrawler
+    from crawl4ai.async_configs import BrowserConfig, CrawlerRunConfig
+    from crawl4ai.models import CrawlResult
+
+
+class BrowserPool:
+    def __init__(
+        self,
+        config: Callable[[], BrowserConfig],
+        size: int = 2,
+        max_pages: int = 50,
+    ):
+        # crawl4ai loads with the first browser, the config is built then
+        self.config = config
+        self.size = max(1, size)
+        self.max_pages = max(1, max_pages)
+        self._slots: Queue[AsyncWebCrawler | None] | None = None
+        self._crawlers: set[AsyncWebCrawler] = set()
+        self._pages: dict[int, int] = {}
+        self._tasks: set[Task] = set()
+        self._lock = Lock()
+        self._loop: AbstractEventLoop | None = None
+
+    async def start(self):
+        async with self._lock:
+            if self._slots is not None:
+                return
+            self._slots = Queue()
+            self._loop = get_running_loop()
+            # First use imports crawl4ai, off the loop
+            await to_thread(self.config)
+            crawlers = await gather(
+                *(self._launch() for _ in range(self.size)), return_exceptions=True
+            )
+            for crawler in crawlers:
+                if isinstance(crawler, BaseException):
+                    logger.error(f"Failed to launch browser: {crawler}")
+                    crawler = None
+                self._slots.put_nowait(crawler)
+            logger.info(f"Browser pool: ready ({len(self._crawlers)}/{self.size})")
+
+    async def close(self):
+        async with self._lock:
+            if self._slots is None:
+                return
+            self._slots = None
+            self._loop = None
+            for task in list(self._tasks):
+                task.cancel()
+            await gather(*self._tasks, return_exceptions=True)
+            await gather(*(self._dispose(crawler) for crawler in list(self._crawlers)))
+            logger.info("Browser pool: closed")
+
+    async def _launch(self) -> AsyncWebCrawler:
+        from crawl4ai import AsyncWebCrawler
+
+        crawler = AsyncWebCrawler(config=self.config(), always_bypass_cache=True)
+        await crawler.start()
+        self._crawlers.add(crawler)
+        self._pages[id(crawler)] = 0
+        return crawler
+
+    async def _dispose(self, crawler: AsyncWebCrawler):
+        self._crawlers.discard(crawler)
+        self._pages.pop(id(crawler), None)
+        try:
+            await crawler.close()
+        except Exception as e:
+            logger.warning(f"Failed to close browser: {e}")
+
+    async def _recycle(self, crawler: AsyncWebCrawler, slots: Queue):
+        await self._dispose(crawler)
+        try:
+            crawler = await self._launch()
+        except Exception as e:
+            logger.error(f"Failed to relaunch browser: {e}")
+            crawler = None
+        slots.put_nowait(crawler)
+
+    @staticmethod
+    def is_healthy(crawler: AsyncWebCrawler) -> bool:
+        browser_manager = getattr(crawler.crawler_strategy, "browser_manager", None)
+        browser = getattr(browser_manager, "browser", None)
+        return crawler.ready and (browser is None or browser.is_connected())
+
+    @asynccontextmanager
+    async def acquire(self) -> AsyncIterator[AsyncWebCrawler]:
+        if self._slots is None:
+            await self.start()
+        slots = self._slots
+        crawler = await slots.get()
+        try:
+            if crawler is not None and not self.is_healthy(crawler):
+                logger.warning("Browser unhealthy, relaunching...")
+                await self._dispose(crawler)
+                crawler = None
+            if crawler is None:
+                crawler = await self._launch()
+        except BaseException:
+            slots.put_nowait(None)
+            raise
+
+        try:
+            yield crawler
+        finally:
+            self._pages[id(crawler)] = self._pages.get(id(crawler), 0) + 1
+            if slots is not self._slots:
+                # Pool closed (or restarted) while the browser was checked out
+                await self._dispose(crawler)
+            elif self._pages[id(crawler)] >= self.max_pages or not self.is_healthy(
+                crawler
+            ):
+                task = create_task(self._recycle(crawler, slots))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+            else:
+                slots.put_nowait(crawler)
+
+    async def crawl(self, url: str, config: CrawlerRunConfig) -> CrawlResult:
+        if self._loop is not None and self._loop is not get_running_loop():
+            # Pooled browsers are bound to the loop that started them
+            from crawl4ai import AsyncWebCrawler
+
+            async with AsyncWebCrawler(
+                config=self.config(), always_bypass_cache=True
+            ) as crawler:
+                return await crawler.arun(url=url, config=config)
+        async with self.acquire() as crawler:
+            return await crawler.arun(url=url, config=config)
@@ -0,0 +1,164 @@
+from asyncio import Task, create_task
+from contextlib import asynccontextmanager
+from json import dumps, loads
+from logging import getLogger
+from os import makedirs, path
+from time import time
+from typing import Any, AsyncIterator, Awaitable, Callable
+
+import coloredlogs
+
+coloredlogs.install()
+logger = getLogger("cache")
+
+from aiosqlite import Connection, connect
+
+from .singleflight import SingleFlight
+
+
+class SearchCache:
+    def __init__(
+        self,
+        db_path: str,
+        ttl: float = 600,
+        stale_ttl: float = 3600,
+        negative_ttl: float = 60,
+        max_entries=1000,
+        flights: SingleFlight | None = None,
+    ):
+        self.db_path = db_path
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.negative_ttl = negative_ttl  # Empty or failed results
+        self.max_entries = max_entries
+        self.flights = flights
+        self._initialized = False
+        self._refreshing: dict[str, Task] = {}
+
+    @staticmethod
+    def key(query: str, sources: list[str], llm: str | None = None) -> str:
+        normalized_query = " ".join(query.lower().split())
+        return f"{normalized_query}|{','.join(sorted(sources))}|{llm or 'csv'}"
+
+    @asynccontextmanager
+    async def _connect(self) -> AsyncIterator[Connection]:
+        if not self._initialized:
+            makedirs(path.dirname(self.db_path), exist_ok=True)
+        async with connect(self.db_path, timeout=10) as db:
+            if not self._initialized:
+                await self._init(db)
+            yield db
+
+    async def _init(self, db: Connection):
+        await db.execute("PRAGMA journal_mode=WAL")
+        await db.execute(
+            "CREATE TABLE IF NOT EXISTS search_cache ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+            "created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        await db.execute(
+            "CREATE INDEX IF NOT EXISTS search_cache_accessed_at "
+            "ON search_cache (accessed_at)"
+        )
+        await db.commit()
+        self._initialized = True
+
+    async def get(self, key: str) -> tuple[Any, bool] | None:
+        now = time()
+        async with self._connect() as db:
+            async with db.execute(
+                "SELECT value, created_at FROM search_cache WHERE key = ?", (key,)
+            ) as cursor:
+                row = await cursor.fetchone()
+            if row is None:
+                return None
+            value, created_at = row
+            value, age = loads(value), now - created_at
+            if not value:
+                # Negative entries are never served stale
+                return ([], True) if age <= self.negative_ttl else None
+            if age > self.ttl + self.stale_ttl:
+                await db.execute("DELETE FROM search_cache WHERE key = ?", (key,))
+                await db.commit()
+                return None
+            await db.execute(
+                "UPDATE search_cache SET accessed_at = ? WHERE key = ?", (now, key)
+            )
+            await db.commit()
+        return value, age <= self.ttl
+
+    async def set(self, key: str, value: Any):
+        now = time()
+        async with self._connect() as db:
+            await db.execute(
+                "INSERT OR REPLACE INTO search_cache "
+                "(key, value, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, dumps(value), now, now),
+            )
+            # LRU eviction
+            await db.execute(
+                "DELETE FROM search_cache WHERE key IN ("
+                "SELECT key FROM search_cache ORDER BY accessed_at DESC "
+                "LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+            await db.commit()
+
+    async def _store(self, key: str, value: Any):
+        try:
+            await self.set(key, value)
+        except Exception as e:
+            logger.error(f"Failed to write cache entry {key}: {e}")
+
+    async def _fresh(self, key: str) -> Any:
+        cached = await self.get(key)
+        return cached[0] if cached and cached[1] else None
+
+    async def _fetch(
+        self, key: str, fetch: Callable[[], Awaitable[Any]], negative: bool = True
+    ) -> Any:
+        # Stored while the lease is still held, so the callers of the other
+        # processes waiting on it find the entry instead of fetching again
+        async def fetch_and_store() -> Any:
+            try:
+                value = await fetch()
+            except Exception:
+                if negative:
+                    await self._store(key, [])
+                raise
+            if value or negative:
+                await self._store(key, value or [])
+            return value
+
+        if self.flights is None:
+            return await fetch_and_store()
+        return await self.flights.run(
+            key, fetch_and_store, recheck=lambda: self._fresh(key)
+        )
+
+    async def _refresh(self, key: str, fetch: Callable[[], Awaitable[Any]]):
+        try:
+            # An empty result doesn't replace the stale one
+            if await self._fetch(key, fetch, negative=False):
+                logger.info(f"Refreshed stale entry: {key}")
+        except Exception as e:
+            logger.error(f"Failed to refresh stale entry {key}: {e}")
+        finally:
+            self._refreshing.pop(key, None)
+
+    async def get_or_fetch(self, key: str, fetch: Callable[[], Awaitable[Any]]) -> Any:
+        try:
+            cached = await self.get(key)
+        except Exception as e:
+            logger.error(f"Failed to read cache entry {key}: {e}")
+            cached = None
+
+        if cached is not None:
+            value, fresh = cached
+            if not fresh and key not in self._refreshing:
+                # Stale-while-revalidate: serve now, refresh in the background
+                self._refreshing[key] = create_task(self._refresh(key, fetch))
+            logger.info(f"Cache {'hit' if fresh else 'hit (stale)'}: {key}")
+            return value
+
+        return await self._fetch(key, fetch)
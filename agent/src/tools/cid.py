@@ -0,0 +1,178 @@
+from asyncio import gather, get_running_loop
+from base64 import b32encode
+from concurrent.futures import ProcessPoolExecutor
+from hashlib import sha256
+from logging import getLogger
+from mmap import ACCESS_READ, mmap
+from multiprocessing import get_context
+from os import getenv, path
+from typing import Any
+
+import coloredlogs
+
+coloredlogs.install()
+logger = getLogger("cid")
+
+# Same layout as kubo's `ipfs add --nocopy`: fixed size chunks stored as raw
+# leaves (the filestore requires them) under a balanced dag-pb tree
+CHUNK_SIZE = int(getenv("IPFS_CHUNK_SIZE", "262144"))
+CID_VERSION = int(getenv("IPFS_CID_VERSION", "0"))
+MAX_LINKS = 174
+# Chunks hashed by a worker per task, 256 MiB with the default chunk size
+SEGMENT_CHUNKS = 1024
+
+RAW, DAG_PB, SHA2_256 = 0x55, 0x70, 0x12
+UNIXFS_FILE = 2
+BASE58 = "123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz"
+
+
+def varint(value: int) -> bytes:
+    encoded = bytearray()
+    while value > 0x7F:
+        encoded.append(value & 0x7F | 0x80)
+        value >>= 7
+    encoded.append(value)
+    return bytes(encoded)
+
+
+def field(number: int, value: int | bytes) -> bytes:
+    # Protobuf varint or length-delimited field
+    if isinstance(value, int):
+        return varint(number << 3) + varint(value)
+    return varint(number << 3 | 2) + varint(len(value)) + value
+
+
+def cid_bytes(digest: bytes, codec: int, version: int) -> bytes:
+    multihash = bytes((SHA2_256, len(digest))) + digest
+    # CIDv0 is the bare multihash, and only exists for dag-pb
+    return (
+        multihash if version == 0 and codec == DAG_PB else bytes((1, codec)) + multihash
+    )
+
+
+def cid_string(cid: bytes) -> str:
+    if cid[0] == 1:
+        return "b" + b32encode(cid).decode().lower().rstrip("=")
+    number, encoded = int.from_bytes(cid, "big"), ""
+    while number:
+        number, remainder = divmod(number, 58)
+        encoded = BASE58[remainder] + encoded
+    return "1" * (len(cid) - len(cid.lstrip(b"\0"))) + encoded
+
+
+def hash_chunks(file_path: str, start: int, end: int, chunk_size: int) -> bytes:
+    # Runs in the worker processes, returns the concatenated chunk digests
+    digests = bytearray()
+    with open(file_path, "rb") as file:
+        if start == end:
+            return sha256().digest()
+        with mmap(file.fileno(), 0, access=ACCESS_READ) as mapped:
+            view = memoryview(mapped)
+            try:
+                for offset in range(start, end, chunk_size):
+                    digests += sha256(
+                        view[offset : min(offset + chunk_size, end)]
+                    ).digest()
+            finally:
+                view.release()
+    return bytes(digests)
+
+
+def build_root(digests: bytes, size: int, chunk_size: int, version: int) -> str:
+    # Nodes are (cid, tsize, file size), leaves first, then each level of
+    # parents holds up to MAX_LINKS children until a single root is left
+    level = []
+    for index in range(0, len(digests), 32):
+        offset = index // 32 * chunk_size
+        length = min(chunk_size, size - offset)
+        level.append((cid_bytes(digests[index : index + 32], RAW, 1), length, length))
+    while len(level) > 1:
+        parents = []
+        for start in range(0, len(level), MAX_LINKS):
+            children = level[start : start + MAX_LINKS]
+            filesize = sum(child[2] for child in children)
+            unixfs = field(1, UNIXFS_FILE) + field(3, filesize)
+            unixfs += b"".join(field(4, child[2]) for child in children)
+            # dag-pb puts the links before the data, names are empty
+            node = b"".join(
+                field(2, field(1, child[0]) + field(2, b"") + field(3, child[1]))
+                for child in children
+            )
+            node += field(1, unixfs)
+            tsize = len(node) + sum(child[1] for child in children)
+            parents.append(
+                (cid_bytes(sha256(node).digest(), DAG_PB, version), tsize, filesize)
+            )
+        level = parents
+    return cid_string(level[0][0])
+
+
+def segments(size: int, chunk_size: int) -> list[tuple[int, int]]:
+    step = chunk_size * SEGMENT_CHUNKS
+    return [(start, min(start + step, size)) for start in range(0, size, step)] or [
+        (0, 0)
+    ]
+
+
+def file_cid(
+    file_path: str, chunk_size: int = CHUNK_SIZE, version: int = CID_VERSION
+) -> str:
+    # Single process reference, what `ipfs add --only-hash --nocopy` answers
+    size = path.getsize(file_path)
+    digests = b"".join(
+        hash_chunks(file_path, start, end, chunk_size)
+        for start, end in segments(size, chunk_size)
+    )
+    return build_root(digests, size, chunk_size, version)
+
+
+class CidHasher:
+    # Computes the CIDs locally, the leaves are hashed by a process pool in
+    # parallel segments so the link is known before the node is done adding
+    def __init__(
+        self,
+        chunk_size: int = CHUNK_SIZE,
+        version: int = CID_VERSION,
+        workers: int = 2,
+    ):
+        self.chunk_size = chunk_size
+        self.version = version
+        self.workers = workers
+        self._executor: ProcessPoolExecutor | None = None
+
+    @property
+    def add_options(self) -> dict[str, Any]:
+        # Passed to `ipfs add` so the node builds the same DAG
+        return dict(
+            chunker=f"size-{self.chunk_size}", raw_leaves=True, cid_version=self.version
+        )
+
+    async def cid(self, file_path: str) -> str:
+        if not path.isfile(file_path):
+            raise FileNotFoundError(f"File not found: {file_path}")
+        if self._executor is None:
+            # Forking the server would copy locks held by its other threads
+            # (libtorrent, sqlite, to_thread), workers start from a clean process
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers, mp_context=get_context("forkserver")
+            )
+        loop = get_running_loop()
+        size = path.getsize(file_path)
+        digests = await gather(
+            *(
+                loop.run_in_executor(
+                    self._executor, hash_chunks, file_path, start, end, self.chunk_size
+                )
+                for start, end in segments(size, self.chunk_size)
+            )
+        )
+        return build_root(b"".join(digests), size, self.chunk_size, self.version)
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(cancel_futures=True)
+            self._executor = None
+            logger.info("CID hasher: closed")
+
+
+cid_hasher = CidHasher(workers=int(getenv("CID_WORKERS", "2")))
@@ -0,0 +1,182 @@
+from contextlib import asynccontextmanager
+from json import dumps, loads
+from logging import getLogger
+from os import makedirs, path
+from time import time
+from typing import Any, AsyncIterator
+
+import coloredlogs
+
+coloredlogs.install()
+logger = getLogger("content")
+
+from aiosqlite import Connection, Row, connect
+
+
+class ContentIndex:
+    # What was already downloaded and added to IPFS, by torrent and wanted file
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._initialized = False
+
+    @staticmethod
+    def key(target: str) -> str:
+        return " ".join(target.lower().split())
+
+    @asynccontextmanager
+    async def _connect(self) -> AsyncIterator[Connection]:
+        if not self._initialized:
+            makedirs(path.dirname(self.db_path), exist_ok=True)
+        async with connect(self.db_path, timeout=10) as db:
+            db.row_factory = Row
+            if not self._initialized:
+                await self._init(db)
+            yield db
+
+    async def _init(self, db: Connection):
+        await db.execute("PRAGMA journal_mode=WAL")
+        await db.execute(
+            "CREATE TABLE IF NOT EXISTS content_index ("
+            "infohash TEXT NOT NULL, target TEXT NOT NULL, "
+            "path TEXT NOT NULL, size INTEGER NOT NULL, "
+            "cid TEXT NOT NULL, url TEXT NOT NULL, created_at REAL NOT NULL, "
+            "files TEXT, hits INTEGER NOT NULL DEFAULT 0, accessed_at REAL, "
+            "PRIMARY KEY (infohash, target))"
+        )
+        async with db.execute("PRAGMA table_info(content_index)") as cursor:
+            columns = {row["name"] for row in await cursor.fetchall()}
+        for column, definition in (
+            ("files", "TEXT"),
+            ("hits", "INTEGER NOT NULL DEFAULT 0"),
+            ("accessed_at", "REAL"),
+        ):
+            if column not in columns:
+                await db.execute(
+                    f"ALTER TABLE content_index ADD COLUMN {column} {definition}"
+                )
+        await db.execute(
+            "CREATE INDEX IF NOT EXISTS content_index_cid ON content_index (cid)"
+        )
+        await db.execute(
+            "CREATE TABLE IF NOT EXISTS evictions ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, infohash TEXT NOT NULL, "
+            "target TEXT NOT NULL, path TEXT NOT NULL, size INTEGER NOT NULL, "
+            "cid TEXT NOT NULL, reason TEXT NOT NULL, freed INTEGER NOT NULL, "
+            "evicted_at REAL NOT NULL)"
+        )
+        await db.commit()
+        self._initialized = True
+
+    async def get(self, infohash: str, target: str) -> dict[str, Any] | None:
+        async with self._connect() as db:
+            async with db.execute(
+                "SELECT * FROM content_index WHERE infohash = ? AND target = ?",
+                (infohash, self.key(target)),
+            ) as cursor:
+                row = await cursor.fetchone()
+        return self._to_entry(row) if row else None
+
+    @staticmethod
+    def _to_entry(row: Row) -> dict[str, Any]:
+        entry = dict(row)
+        entry["files"] = loads(entry["files"]) if entry["files"] else {}
+        return entry
+
+    async def set(
+        self,
+        infohash: str,
+        target: str,
+        file_path: str,
+        size: int,
+        cid: str,
+        url: str,
+        files: dict[str, str] | None = None,
+    ):
+        # files: the CID of every file under a directory, each of them is pinned
+        now = time()
+        async with self._connect() as db:
+            await db.execute(
+                "INSERT OR REPLACE INTO content_index (infohash, target, path, size, "
+                "cid, url, created_at, files, accessed_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    infohash,
+                    self.key(target),
+                    file_path,
+                    size,
+                    cid,
+                    url,
+                    now,
+                    dumps(files or {}),
+                    now,
+                ),
+            )
+            await db.commit()
+
+    async def touch(self, infohash: str, target: str):
+        async with self._connect() as db:
+            await db.execute(
+                "UPDATE content_index SET hits = hits + 1, accessed_at = ? "
+                "WHERE infohash = ? AND target = ?",
+                (time(), infohash, self.key(target)),
+            )
+            await db.commit()
+
+    async def entries(self, hit_bonus: float = 0) -> list[dict[str, Any]]:
+        # Least recently used first, each hit counts as hit_bonus seconds younger
+        async with self._connect() as db:
+            async with db.execute(
+                "SELECT * FROM content_index "
+                "ORDER BY IFNULL(accessed_at, created_at) + hits * ?",
+                (hit_bonus,),
+            ) as cursor:
+                return [self._to_entry(row) for row in await cursor.fetchall()]
+
+    async def evict(self, entry: dict[str, Any], reason: str, freed: int):
+        async with self._connect() as db:
+            await db.execute(
+                "DELETE FROM content_index WHERE infohash = ? AND target = ?",
+                (entry["infohash"], entry["target"]),
+            )
+            await db.execute(
+                "INSERT INTO evictions "
+                "(infohash, target, path, size, cid, reason, freed, evicted_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    entry["infohash"],
+                    entry["target"],
+                    entry["path"],
+                    entry["size"],
+                    entry["cid"],
+                    reason,
+                    freed,
+                    time(),
+                ),
+            )
+            await db.commit()
+
+    async def stats(self) -> dict[str, Any]:
+        async with self._connect() as db:
+            async with db.execute(
+                "SELECT COUNT(*) AS entries, IFNULL(SUM(size), 0) AS bytes "
+                "FROM content_index"
+            ) as cursor:
+                indexed = await cursor.fetchone()
+            async with db.execute(
+                "SELECT COUNT(*) AS evictions, IFNULL(SUM(freed), 0) AS freed_bytes, "
+                "MAX(evicted_at) AS last_eviction_at FROM evictions"
+            ) as cursor:
+                evicted = dict(await cursor.fetchone())
+        return dict(
+            indexed_entries=indexed["entries"],
+            indexed_bytes=indexed["bytes"],
+            **evicted,
+        )
+
+    async def delete(self, infohash: str, target: str):
+        async with self._connect() as db:
+            await db.execute(
+                "DELETE FROM content_index WHERE infohash = ? AND target = ?",
+                (infohash, self.key(target)),
+            )
+            await db.commit()
@@ -1,9 +1,10 @@
-from asyncio import run
+from asyncio import Task, create_task, gather, to_thread
+from functools import partial
 from json import dumps, loads
 from logging import getLogger
-from os import getenv, makedirs, path, walk
-from pathlib import Path
-from shutil import rmtree
+from os import getenv, getpid, makedirs, path, walk
+from shutil import disk_usage
+from time import time
 from typing import Any
 
 import coloredlogs
@@ -12,10 +13,16 @@ from pydantic import BaseModel, Field
 coloredlogs.install()
 logger = getLogger("downloader")
 
-from aioipfs import AsyncIPFS
 from coinbase_agentkit import ActionProvider, WalletProvider, create_action
-from openai import OpenAI
-from torrentp import TorrentDownloader
+
+from .cid import cid_hasher
+from .content import ContentIndex
+from .eviction import EvictionManager
+from .ipfs import IpfsError, ipfs_pool
+from .jobs import JobQueue, JobStore, Reporter
+from .matcher import AMBIGUITY_MARGIN, is_ambiguous, match_files
+from .streaming import FileStreamer, StreamTokens
+from .torrents import FileCallback, TorrentClient, infohash
 
 DOWNLOAD_DIR = (
     "/shared/downloads"
@@ -25,17 +32,85 @@ DOWNLOAD_DIR = (
     )
 )
 makedirs(DOWNLOAD_DIR, exist_ok=True)
+DATA_DIR = path.join(path.dirname(path.dirname(path.dirname(__file__))), "data")
+
+ALL_FILES = "*"
+SINGLE_FILE_DOWNLOADS = getenv("SINGLE_FILE_DOWNLOADS", "true").lower() == "true"
+MAX_ACTIVE_DOWNLOADS = int(getenv("MAX_ACTIVE_DOWNLOADS", "3"))
+MIN_FREE_DISK = int(float(getenv("DOWNLOAD_MIN_FREE_GB", "5")) * 1024**3)
+BUDGET_BALANCE_INTERVAL = 5
+
+torrent_client = TorrentClient(
+    DOWNLOAD_DIR,
+    port=int(getenv("TORRENT_PORT", "6881")),
+    metadata_timeout=float(getenv("TORRENT_METADATA_TIMEOUT", "300")),
+    download_budget=int(getenv("TORRENT_DOWNLOAD_LIMIT_KB", "0")) * 1024,
+    upload_budget=int(getenv("TORRENT_UPLOAD_LIMIT_KB", "0")) * 1024,
+    resume_interval=float(getenv("TORRENT_RESUME_INTERVAL", "30")),
+)
+last_budget_balance = dict(at=0.0)
+content_index = ContentIndex(path.join(DATA_DIR, "database", "content.sqlite"))
+
 
+async def pick_file(
+    target: str, file_list: list[str], sizes: list[int], matches: list | None = None
+) -> str | None:
+    scored = match_files(target, file_list, sizes)
+    logger.info(
+        f"Match scores for {target}: "
+        f"{[(path.basename(match['path']), match['score']) for match in scored[:5]]}"
+    )
+    if matches is not None:
+        matches.extend(scored[:5])
+    if not scored:
+        return None
+    if not is_ambiguous(scored):
+        return scored[0]["path"]
+    # Too close to call, the LLM only chooses between the best candidates
+    candidates = [
+        match["path"]
+        for match in scored
+        if scored[0]["score"] - match["score"] < AMBIGUITY_MARGIN
+    ]
+    try:
+        # The OpenAI client blocks, keep it off the server loop
+        _, file = await to_thread(get_root_and_file, target, candidates)
+    except Exception as e:
+        logger.warning(f"LLM file match failed: {e}")
+        return scored[0]["path"]
+    return file if file in candidates else scored[0]["path"]
 
-async def download_torrent(magnet_link: str):
-    await TorrentDownloader(
-        magnet_link, DOWNLOAD_DIR, stop_after_download=True
-    ).start_download()
 
+async def select_file(
+    target: str, file_list: list[str], sizes: list[int], matches: list | None = None
+) -> int | None:
+    file = await pick_file(target, file_list, sizes, matches=matches)
+    return file_list.index(file) if file else None
 
-def list_all_files() -> list[str]:
+
+async def download_torrent(
+    magnet_link: str,
+    target: str,
+    report: Reporter | None = None,
+    matches: list | None = None,
+    on_file: FileCallback | None = None,
+) -> str:
+    # Picks the file from the torrent metadata so only its pieces are fetched
+    select = (
+        partial(select_file, target, matches=matches)
+        if SINGLE_FILE_DOWNLOADS and target != ALL_FILES
+        else None
+    )
+    return await torrent_client.download(
+        magnet_link, on_progress=report, select=select, on_file=on_file
+    )
+
+
+def list_all_files(directory: str = DOWNLOAD_DIR) -> list[str]:
+    if path.isfile(directory):
+        return [directory]
     file_paths = []
-    for root, _dirs, files in walk(DOWNLOAD_DIR):
+    for root, _dirs, files in walk(directory):
         for file in files:
             file_paths.append(path.join(root, file))
     logger.info(f"Files found: {file_paths}")
@@ -48,6 +123,8 @@ class File(BaseModel):
 
 
 def get_root_and_file(filename: str, file_list: list[str]) -> tuple[str, str]:
+    from openai import OpenAI
+
     client = OpenAI(base_url=getenv("GROQ_API_BASE"), api_key=getenv("GROQ_API_KEY"))
     response = client.chat.completions.create(
         model=getenv("GROQ_API_MODEL"),
@@ -78,55 +155,339 @@ def get_root_and_file(filename: str, file_list: list[str]) -> tuple[str, str]:
     return root, file
 
 
-async def add_to_ipfs(
-    file_path: str, host: str = getenv("IPFS_HOST", "ipfs-node"), port: int = 5001
-) -> dict[str, str]:
-    if not Path(file_path).exists():
-        logger.error(f"File not found: {file_path}")
-        return {}
+async def add_to_ipfs(file_path: str) -> dict[str, str]:
+    # nocopy: blocks reference the shared file (kubo filestore) instead of a copy,
+    # the DAG options are explicit so the CIDs match the ones computed locally
+    return await ipfs_pool.add(
+        file_path,
+        pin=True,
+        recursive=True,
+        quieter=True,
+        nocopy=True,
+        **cid_hasher.add_options,
+    )
+
 
-    files = {}
+async def add_directory(directory: str, cids: dict[str, str]) -> str | None:
+    # Links the already added files into an MFS directory instead of adding
+    # (and hashing) the whole tree again
+    root = f"/{path.basename(directory)}"
     try:
-        client = AsyncIPFS(host=host, port=port)
-        logger.info(f"Connecting to IPFS node at {host}:{port}...")
-        async with client as ipfs:
-            logger.info(f"Adding file: {file_path}")
-            async for added in ipfs.add(
-                file_path, pin=True, recursive=True, quieter=True, no_copy=True
-            ):
-                curr_hash, curr_name = added["Hash"], added["Name"]
-                files[curr_name] = curr_hash
-                logger.info(f"File added/pinned: {added}")
-            if curr_hash and curr_name:
-                try:
-                    await ipfs.files.cp(f"/ipfs/{curr_hash}", f"/{curr_name}")
-                except:
-                    pass
-    except Exception as e:
-        logger.info(f"Failed to interact with IPFS node: {str(e)}")
-    await client.close()
+        for file_path, cid in cids.items():
+            await ipfs_pool.copy_to_mfs(
+                cid, f"{root}/{path.relpath(file_path, directory)}", parents=True
+            )
+        cid = await ipfs_pool.mfs_cid(root)
+        await ipfs_pool.pin(cid)
+        return cid
+    except IpfsError as e:
+        logger.warning(f"No directory CID for {directory}: {e}")
+        return None
+
+
+class AddPipeline:
+    # Adds every file to IPFS as soon as it is downloaded, while the rest of
+    # the torrent is still coming, the IPFS pool bounds the concurrent adds.
+    # The CIDs are also computed locally, their links are reported as soon as
+    # the hashing is done and checked against the node's once it has added
+    def __init__(self, report: Reporter | None = None):
+        self.cids: dict[str, str] = {}
+        self.precomputed: dict[str, str] = {}
+        self._report = report
+        self._status = "downloading"
+        self._progress: dict = {}
+        self._tasks: list[Task] = []
+
+    async def add(self, file_path: str):
+        self._tasks.append(create_task(self._add(file_path)))
+
+    async def _add(self, file_path: str):
+        adding = create_task(add_to_ipfs(file_path))
+        try:
+            started = time()
+            self.precomputed[file_path] = await cid_hasher.cid(file_path)
+            logger.info(
+                f"CID computed in {time() - started:.1f}s: "
+                f"{path.basename(file_path)} ({self.precomputed[file_path]})"
+            )
+            if not adding.done():
+                await self.report(self._status, self._progress)
+        except Exception as e:
+            logger.warning(f"No local CID for {file_path}: {e!r}")
+        files = await adding
+        cid = self.cids[file_path] = list(files.values())[-1]
+        precomputed = self.precomputed.pop(file_path, None)
+        if precomputed and precomputed != cid:
+            logger.error(
+                f"Local CID mismatch for {file_path}: {precomputed}, "
+                f"the node added {cid}"
+            )
+
+    def progress(self) -> dict[str, Any]:
+        # Added files first, then the ones whose CID is only known locally
+        return dict(
+            files_added=len(self.cids),
+            files_adding=len(self._tasks) - len(self.cids),
+            links=gateway_links(
+                {
+                    path.basename(file_path): cid
+                    for file_path, cid in {**self.precomputed, **self.cids}.items()
+                }
+            ),
+            pinning=[path.basename(file_path) for file_path in self.precomputed],
+        )
+
+    async def report(self, status: str, progress: dict | None = None):
+        self._status, self._progress = status, progress or {}
+        if self._report:
+            await self._report(status, {**self._progress, **self.progress()})
+
+    async def wait(self) -> dict[str, str]:
+        await gather(*self._tasks)
+        return self.cids
+
+    def cancel(self):
+        for task in self._tasks:
+            task.cancel()
+
+
+def content_size(content_path: str) -> int:
+    if path.isfile(content_path):
+        return path.getsize(content_path)
+    return sum(path.getsize(file_path) for file_path in list_all_files(content_path))
+
+
+async def find_content(magnet_link: str, target: str) -> dict[str, Any] | None:
+    key = infohash(magnet_link)
+    entry = await content_index.get(key, target)
+    if entry is None:
+        return None
+    try:
+        pinned = await ipfs_pool.is_pinned(entry["cid"])
+    except IpfsError as e:
+        logger.warning(f"Content index bypassed: {e}")
+        return None
+    # Files are added with nocopy, the pin is only valid while the file is there
+    if (
+        not pinned
+        or not path.exists(entry["path"])
+        or content_size(entry["path"]) != entry["size"]
+    ):
+        logger.warning(f"Dropping stale content index entry: {entry['path']}")
+        await content_index.delete(key, target)
+        return None
+    logger.info(f"Already in IPFS: {entry['path']} ({entry['cid']})")
+    await content_index.touch(key, target)
+    return entry
+
+
+def gateway_links(files: dict[str, str]) -> dict[str, str]:
+    return {fname: f"https://ipfs.video/gw/{fhash}" for fname, fhash in files.items()}
+
+
+async def download(
+    filename: str,
+    magnet_link: str,
+    target: str | None = None,
+    report: Reporter | None = None,
+    matches: list | None = None,
+) -> dict[str, str]:
+    pipeline = AddPipeline(report)
+    try:
+        downloaded = await download_torrent(
+            magnet_link,
+            target or filename,
+            report=pipeline.report,
+            matches=matches,
+            on_file=pipeline.add,
+        )
+        await pipeline.report("adding")
+        cids = await pipeline.wait()
+    finally:
+        pipeline.cancel()
+    name = path.basename(downloaded)
+    if path.isfile(downloaded):
+        cid = cids[downloaded]
+        files = {name: cid}
+        try:
+            await ipfs_pool.copy_to_mfs(cid, f"/{name}")
+        except IpfsError as e:
+            logger.warning(f"Not listed in MFS: {e}")
+    else:
+        cid = await add_directory(downloaded, cids)
+        files = {
+            path.relpath(file_path, path.dirname(downloaded)): file_cid
+            for file_path, file_cid in cids.items()
+        }
+        if cid:
+            files[name] = cid
+    if cid:
+        await content_index.set(
+            infohash(magnet_link),
+            target or filename,
+            downloaded,
+            content_size(downloaded),
+            cid,
+            gateway_links({name: cid})[name],
+            files=cids,
+        )
     return files
 
 
-def rm(file_path: str):
-    if Path(file_path).exists():
-        logger.info(f"Deleting: {file_path}")
-        if Path(file_path).is_dir():
-            rmtree(file_path)
-        else:
-            Path(file_path).unlink()
+def human_size(size: float) -> str:
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024:
+            break
+        size /= 1024
+    else:
+        unit = "TB"
+    return f"{size:.1f} {unit}"
 
 
-async def download(filename: str, magnet_link: str) -> dict[str, str]:
-    await download_torrent(magnet_link)
-    file_list = list_all_files()
-    _, file = get_root_and_file(filename, file_list)
-    files = await add_to_ipfs(file)
-    # rm(root)
-    return (
-        {fname: f"https://ipfs.video/gw/{fhash}" for fname, fhash in files.items()}
-        if files
-        else {}
+async def reserved_disk(exclude: str | None = None) -> int:
+    # Bytes still to be written by the running downloads of every process
+    return sum(
+        max(progress.get("bytes_total", 0) - progress.get("bytes_done", 0), 0)
+        for job in await download_jobs.store.running(download_jobs.stale_after)
+        if job["id"] != exclude and (progress := job["progress"] or {})
+    )
+
+
+async def admit_download(_job: dict[str, Any]) -> str | None:
+    reserved = await reserved_disk()
+    if disk_usage(DOWNLOAD_DIR).free - reserved < MIN_FREE_DISK:
+        await eviction_manager.run(needed=reserved + MIN_FREE_DISK)
+    available = disk_usage(DOWNLOAD_DIR).free - reserved
+    if available < MIN_FREE_DISK:
+        return (
+            f"Waiting for disk space: {human_size(max(available, 0))} available, "
+            f"{human_size(MIN_FREE_DISK)} kept free"
+        )
+    return None
+
+
+async def balance_budgets():
+    # Splits the global rate budgets by the share of running torrents per process
+    if not (torrent_client.download_budget or torrent_client.upload_budget):
+        return
+    if time() - last_budget_balance["at"] < BUDGET_BALANCE_INTERVAL:
+        return
+    last_budget_balance["at"] = time()
+    running = await download_jobs.store.running(download_jobs.stale_after)
+    local = sum(job["pid"] == getpid() for job in running)
+    torrent_client.set_budget_share(local / len(running) if running else 1)
+
+
+def stream_files(file_paths: list[str]) -> dict[str, dict[str, int]]:
+    # Files of a finished download, as streamed from the downloads folder
+    return {
+        path.relpath(file_path, DOWNLOAD_DIR): dict(
+            size=path.getsize(file_path), ready=path.getsize(file_path)
+        )
+        for file_path in file_paths
+    }
+
+
+async def run_download_job(job: dict[str, Any], report: Reporter) -> dict[str, Any]:
+    checked_disk = False
+    streamed = {}
+
+    async def on_progress(status: str, progress: dict | None = None):
+        nonlocal checked_disk
+        if progress and "files" in progress:
+            streamed.update(progress["files"])
+        if status == "downloading" and not checked_disk:
+            # Torrent size is only known once the metadata arrived
+            checked_disk = True
+            needed = progress["bytes_total"] - progress["bytes_done"]
+            kept = await reserved_disk(exclude=job["id"]) + MIN_FREE_DISK
+            if needed > disk_usage(DOWNLOAD_DIR).free - kept:
+                await eviction_manager.run(needed=needed + kept)
+            available = disk_usage(DOWNLOAD_DIR).free - kept
+            if needed > available:
+                raise OSError(
+                    f"Not enough disk space: {human_size(needed)} needed, "
+                    f"{human_size(max(available, 0))} available"
+                )
+        await balance_budgets()
+        await report(status, progress)
+
+    matches = []
+    files = await download(
+        job["filename"],
+        job["magnet_link"],
+        target=job["target"],
+        report=on_progress,
+        matches=matches,
+    )
+    if not files:
+        raise RuntimeError("Nothing could be added to IPFS")
+    torrent_client.forget(job["magnet_link"])
+    return dict(
+        cids=files,
+        links=gateway_links(files),
+        matches=matches,
+        files={name: dict(file, ready=file["size"]) for name, file in streamed.items()},
+    )
+
+
+download_jobs = JobQueue(
+    JobStore(path.join(DATA_DIR, "database", "jobs.sqlite")),
+    run_download_job,
+    max_running=MAX_ACTIVE_DOWNLOADS,
+    admit=admit_download,
+)
+
+
+async def busy_infohashes() -> set[str]:
+    active = await download_jobs.store.active(download_jobs.stale_after)
+    return {job["infohash"] for job in active}
+
+
+eviction_manager = EvictionManager(
+    DOWNLOAD_DIR,
+    content_index,
+    ipfs_pool,
+    busy_infohashes,
+    path.join(DATA_DIR, "database", "eviction.lock"),
+    high_watermark=float(getenv("DISK_HIGH_WATERMARK", "0.9")),
+    low_watermark=float(getenv("DISK_LOW_WATERMARK", "0.8")),
+    interval=float(getenv("EVICTION_INTERVAL", "60")),
+    hit_bonus=float(getenv("EVICTION_HIT_BONUS_HOURS", "24")) * 3600,
+)
+
+
+file_streamer = FileStreamer(
+    DOWNLOAD_DIR,
+    download_jobs,
+    torrent_client,
+    StreamTokens(
+        path.join(DATA_DIR, "database", "stream.key"),
+        ttl=float(getenv("STREAM_TOKEN_TTL_HOURS", "24")) * 3600,
+        secret=getenv("STREAM_SECRET") or None,
+    ),
+    getenv("STREAM_BASE_URL", "http://localhost:1789"),
+    max_range=int(float(getenv("STREAM_MAX_RANGE_MB", "8")) * 1024**2),
+    stall_timeout=float(getenv("STREAM_STALL_TIMEOUT", "60")),
+)
+
+
+def job_summary(job: dict[str, Any]) -> dict[str, Any]:
+    progress = job["progress"]
+    if progress:
+        # Listed with their stream links instead
+        progress = {key: value for key, value in progress.items() if key != "files"}
+    return dict(
+        job_id=job["id"],
+        filename=job["filename"],
+        target=job["target"],
+        status=job["status"],
+        progress=progress,
+        # Links computed locally show up while the files are still being pinned
+        links=(job["result"] or job["progress"] or {}).get("links"),
+        # Playable at once from this server, even while downloading
+        stream=file_streamer.urls(job),
+        error=job["error"],
     )
 
 
@@ -142,6 +503,21 @@ class DownloadToIPFSSchema(BaseModel):
         ...,
         description="Magnet link of the torrent file.",
     )
+    target: str | None = Field(
+        None,
+        description=(
+            "The single file wanted from a torrent holding several ones, like an "
+            "episode (e.g. 'S01E03') from a season pack. Only this file is downloaded. "
+            f"Use '{ALL_FILES}' to download every file, added to IPFS as a directory."
+        ),
+    )
+
+
+class DownloadStatusSchema(BaseModel):
+    job_id: str = Field(
+        ...,
+        description="Id of the download job returned by download-to-ipfs.",
+    )
 
 
 class DownloaderActionProvider(ActionProvider[WalletProvider]):
@@ -154,15 +530,51 @@ class DownloaderActionProvider(ActionProvider[WalletProvider]):
     @create_action(
         name="download-to-ipfs",
         description=(
-            "This tool will download a torrent file using the provided filename "
-            "and magnet link and add it to IPFS, returning a dictionary with the "
-            "added files' names and links."
+            "This tool will start downloading a torrent file in the background using the "
+            "provided filename and magnet link, then add it to IPFS. It returns at once "
+            "with a job id: tell the user the download has started, they can follow its "
+            "progress, and ask you later for the IPFS links. The stream links can be "
+            "played right away, while the file is still downloading."
         ),
         schema=DownloadToIPFSSchema,
     )
-    def download_to_ipfs(self, args: dict[str, Any]) -> str:
-        files = run(download(args["filename"], args["magnet_link"]))
-        return f"<download-to-ipfs>{dumps(files)}</download-to-ipfs>"
+    async def download_to_ipfs(self, args: dict[str, Any]) -> str:
+        entry = await find_content(
+            args["magnet_link"], args.get("target") or args["filename"]
+        )
+        name = path.basename(entry["path"]) if entry else None
+        job = await download_jobs.submit(
+            filename=args["filename"],
+            magnet_link=args["magnet_link"],
+            infohash=infohash(args["magnet_link"]),
+            target=args.get("target"),
+            result=(
+                dict(
+                    cids={name: entry["cid"]},
+                    links={name: entry["url"]},
+                    files=stream_files(list_all_files(entry["path"])),
+                )
+                if entry
+                else None
+            ),
+        )
+        return f"<download-to-ipfs>{dumps(job_summary(job))}</download-to-ipfs>"
+
+    @create_action(
+        name="get-download-status",
+        description=(
+            "This tool will return the status and progress of a download job started by "
+            "download-to-ipfs, with the files' names and links: they work as soon as a "
+            "file is downloaded, even while it is still being pinned. The stream links "
+            "play the files from this server before that."
+        ),
+        schema=DownloadStatusSchema,
+    )
+    async def get_download_status(self, args: dict[str, Any]) -> str:
+        job = await download_jobs.get(args["job_id"])
+        if job is None:
+            return f"No download job found with id {args['job_id']}."
+        return f"<download-status>{dumps(job_summary(job))}</download-status>"
 
 
 def downloader_action_provider():
@@ -0,0 +1,221 @@
+from asyncio import Lock, Task, create_task, sleep, to_thread
+from contextlib import contextmanager, suppress
+from fcntl import LOCK_EX, LOCK_NB, LOCK_UN, flock
+from logging import getLogger
+from os import makedirs, path, rmdir, unlink
+from shutil import disk_usage, rmtree
+from time import time
+from typing import Any, Awaitable, Callable, Iterator
+
+import coloredlogs
+
+coloredlogs.install()
+logger = getLogger("eviction")
+
+from .content import ContentIndex
+from .ipfs import IpfsError, IpfsPool
+
+
+def nested(path_a: str, path_b: str) -> bool:
+    return (
+        path_a == path_b
+        or path_a.startswith(path_b + path.sep)
+        or path_b.startswith(path_a + path.sep)
+    )
+
+
+def delete(content_path: str, root: str):
+    if path.isdir(content_path):
+        rmtree(content_path, ignore_errors=True)
+    elif path.exists(content_path):
+        unlink(content_path)
+    # Torrent folders left empty by single file downloads
+    parent = path.dirname(content_path)
+    while parent.startswith(root + path.sep):
+        try:
+            rmdir(parent)
+        except OSError:
+            break
+        parent = path.dirname(parent)
+
+
+class EvictionManager:
+    # Keeps the downloads disk between its watermarks, least recently and least
+    # often requested content first. Files are added with nocopy, the node
+    # reads them back from the disk, so their pins, MFS and filestore entries
+    # are removed on purpose before the files are deleted, never left dangling
+    def __init__(
+        self,
+        directory: str,
+        index: ContentIndex,
+        ipfs: IpfsPool,
+        busy: Callable[[], Awaitable[set[str]]],
+        lock_path: str,
+        high_watermark: float = 0.9,
+        low_watermark: float = 0.8,
+        interval: float = 60,
+        hit_bonus: float = 86400,
+    ):
+        self.directory = directory
+        self.index = index
+        self.ipfs = ipfs
+        self.busy = busy  # Infohashes of the jobs still using their files
+        self.lock_path = lock_path
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.interval = interval
+        self.hit_bonus = hit_bonus
+        self.runs = 0
+        self.errors = 0
+        self.last_run_at: float | None = None
+        self._lock = Lock()
+        self._task: Task | None = None
+
+    async def start(self):
+        if self._task is None:
+            self._task = create_task(self._run_forever())
+            logger.info(
+                f"Eviction: ready ({self.low_watermark:.0%}-{self.high_watermark:.0%})"
+            )
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            with suppress(BaseException):
+                await self._task
+            self._task = None
+            logger.info("Eviction: closed")
+
+    async def _run_forever(self):
+        while True:
+            try:
+                await self.run()
+            except Exception as e:
+                self.errors += 1
+                logger.error(f"Eviction failed: {e!r}")
+            await sleep(self.interval)
+
+    def _enough(self, needed: int, watermark: float) -> bool:
+        # Room asked for by a download, or the watermark for the background runs
+        total, used, free = disk_usage(self.directory)
+        return free >= needed if needed else used / total < watermark
+
+    @contextmanager
+    def _exclusive(self) -> Iterator[bool]:
+        # One evicting process at a time, the others skip their round
+        makedirs(path.dirname(self.lock_path), exist_ok=True)
+        with open(self.lock_path, "w") as lock:
+            try:
+                flock(lock, LOCK_EX | LOCK_NB)
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                flock(lock, LOCK_UN)
+
+    async def run(self, needed: int = 0) -> int:
+        # Evicts down to the low watermark once over the high one, or until the
+        # needed bytes are free, returns the bytes freed
+        if self._enough(needed, self.high_watermark):
+            return 0
+        async with self._lock:
+            with self._exclusive() as acquired:
+                if not acquired:
+                    return 0
+                self.runs += 1
+                self.last_run_at = time()
+                return await self._evict(needed)
+
+    async def _evict(self, needed: int) -> int:
+        free_before = disk_usage(self.directory).free
+        busy = await self.busy()
+        entries = await self.index.entries(self.hit_bonus)
+        # Entries sharing files on the disk go together, everything under the
+        # outermost folder is deleted with it, so a group is ranked by its most
+        # recently or often requested entry
+        groups: dict[str, list[dict[str, Any]]] = {}
+        for entry in entries:
+            root = min(
+                (
+                    other["path"]
+                    for other in entries
+                    if nested(entry["path"], other["path"])
+                ),
+                key=len,
+            )
+            groups.setdefault(root, []).append(entry)
+        left = list(entries)
+        evicted = 0
+        for group in sorted(
+            groups.values(), key=lambda group: max(map(entries.index, group))
+        ):
+            if self._enough(needed, self.low_watermark):
+                break
+            if any(entry["infohash"] in busy for entry in group):
+                continue
+            if await self._evict_group(group, left, needed):
+                evicted += len(group)
+        freed = max(disk_usage(self.directory).free - free_before, 0)
+        if evicted:
+            logger.warning(
+                f"Evicted {evicted} download(s), {freed / 1024**2:.0f} MB freed"
+            )
+        elif not self._enough(needed, self.low_watermark):
+            logger.warning("Disk over its watermark, nothing left to evict")
+        return freed
+
+    async def _evict_group(
+        self, group: list[dict[str, Any]], left: list[dict[str, Any]], needed: int
+    ) -> bool:
+        # CIDs still backed by the files of other downloads stay pinned
+        kept = {
+            cid
+            for other in left
+            if other not in group
+            for cid in (other["cid"], *other["files"].values())
+        }
+        cids = {
+            cid
+            for entry in group
+            for cid in (entry["cid"], *entry["files"].values())
+            if cid not in kept
+        }
+        try:
+            for entry in group:
+                # MFS entries also keep their blocks from the garbage collector
+                await self.ipfs.remove_from_mfs(f"/{path.basename(entry['path'])}")
+            for cid in cids:
+                await self.ipfs.unpin(cid)
+            if cids:
+                await self.ipfs.collect_garbage()
+        except IpfsError as e:
+            self.errors += 1
+            logger.warning(f"Not evicting {group[0]['path']}: {e}")
+            return False
+        total, used, free_before = disk_usage(self.directory)
+        reason = f"{needed} bytes needed" if needed else f"disk {used / total:.0%} full"
+        for entry in sorted(group, key=lambda entry: len(entry["path"])):
+            await to_thread(delete, entry["path"], self.directory)
+            freed = max(disk_usage(self.directory).free - free_before, 0)
+            free_before += freed
+            await self.index.evict(entry, reason, freed)
+            left.remove(entry)
+            logger.info(f"Evicted {entry['path']} ({entry['cid']}): {reason}")
+        return True
+
+    async def metrics(self) -> dict[str, Any]:
+        total, used, free = disk_usage(self.directory)
+        return dict(
+            disk_total=total,
+            disk_used=used,
+            disk_free=free,
+            disk_usage=round(used / total, 4),
+            high_watermark=self.high_watermark,
+            low_watermark=self.low_watermark,
+            **await self.index.stats(),
+            runs=self.runs,
+            errors=self.errors,
+            last_run_at=self.last_run_at,
+        )
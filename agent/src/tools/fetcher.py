@@ -0,0 +1,147 @@
+from __future__ import annotations
+
+import re
+from asyncio import AbstractEventLoop, Lock, get_running_loop, to_thread
+from logging import getLogger
+from typing import TYPE_CHECKING
+
+import coloredlogs
+
+coloredlogs.install()
+logger = getLogger("fetcher")
+
+from aiohttp import ClientSession, ClientTimeout, TCPConnector
+
+if TYPE_CHECKING:
+    from crawl4ai.async_configs import CrawlerRunConfig
+    from crawl4ai.models import CrawlResult
+
+HTTP_HEADERS = {
+    "User-Agent": (
+        "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 "
+        "(KHTML, like Gecko) Chrome/136.0.0.0 Safari/537.36"
+    ),
+    "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
+    "Accept-Language": "en-US,en;q=0.9",
+    "Accept-Encoding": "gzip, deflate, br",
+}
+
+CHALLENGE_MARKERS = (
+    "cf-browser-verification",
+    "challenge-platform",
+    "cf-chl-",
+    "just a moment...",
+    "ddos-guard",
+    "enable javascript",
+    "captcha",
+)
+SCRIPTS_AND_TAGS = re.compile(r"<script.*?</script>|<style.*?</style>|<[^>]+>", re.S)
+MIN_TEXT_CHARS = 500
+
+
+class BrowserRequiredError(Exception):
+    pass
+
+
+def looks_like_js_shell(
+    status: int, html: str, markers: list[str] | None = None
+) -> bool:
+    if status >= 400:
+        return True
+    if markers:
+        return not any(marker in html for marker in markers)
+    head = html[:20000].lower()
+    if any(challenge in head for challenge in CHALLENGE_MARKERS):
+        return True
+    # Client-side rendered pages ship (almost) no text without JavaScript
+    return len(SCRIPTS_AND_TAGS.sub("", html).strip()) < MIN_TEXT_CHARS
+
+
+def process_html(url: str, html: str, config: CrawlerRunConfig) -> CrawlResult:
+    # Same scraping + markdown steps AsyncWebCrawler runs on a rendered page
+    from crawl4ai.markdown_generation_strategy import DefaultMarkdownGenerator
+    from crawl4ai.models import CrawlResult
+    from crawl4ai.utils import sanitize_input_encode
+
+    params = config.__dict__.copy()
+    params.pop("url", None)
+    scraped = config.scraping_strategy.scrap(url, html, **params)
+    cleaned_html = sanitize_input_encode(scraped.cleaned_html)
+    markdown_generator = config.markdown_generator or DefaultMarkdownGenerator()
+    markdown = markdown_generator.generate_markdown(
+        input_html=cleaned_html, base_url=url
+    )
+    return CrawlResult(
+        url=url,
+        html=html,
+        success=True,
+        cleaned_html=cleaned_html,
+        markdown=markdown,
+    )
+
+
+class HttpPool:
+    def __init__(self, limit: int = 32, limit_per_host: int = 8, timeout: float = 20):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.timeout = timeout
+        self._session: ClientSession | None = None
+        self._loop: AbstractEventLoop | None = None
+        self._lock = Lock()
+
+    def _create_session(self) -> ClientSession:
+        return ClientSession(
+            connector=TCPConnector(
+                limit=self.limit,
+                limit_per_host=self.limit_per_host,
+                keepalive_timeout=60,
+                ttl_dns_cache=300,
+            ),
+            headers=HTTP_HEADERS,
+            timeout=ClientTimeout(total=self.timeout),
+            auto_decompress=True,
+        )
+
+    async def start(self):
+        async with self._lock:
+            if self._session is None:
+                self._session = self._create_session()
+                self._loop = get_running_loop()
+                logger.info("HTTP pool: ready")
+
+    async def close(self):
+        async with self._lock:
+            if self._session is not None:
+                await self._session.close()
+                self._session, self._loop = None, None
+                logger.info("HTTP pool: closed")
+
+    async def get(self, url: str, timeout: float | None = None) -> tuple[int, str]:
+        if self._session is None:
+            await self.start()
+        request_timeout = ClientTimeout(total=timeout or self.timeout)
+        if self._loop is not get_running_loop():
+            # Pooled connections are bound to the loop that opened them
+            async with self._create_session() as session:
+                async with session.get(url, timeout=request_timeout) as response:
+                    return response.status, await response.text(errors="replace")
+        async with self._session.get(url, timeout=request_timeout) as response:
+            return response.status, await response.text(errors="replace")
+
+    async def crawl(
+        self,
+        url: str,
+        config: CrawlerRunConfig,
+        markers: list[str] | None = None,
+        process: bool = True,
+        timeout: float | None = None,
+    ) -> CrawlResult:
+        status, html = await self.get(url, timeout=timeout)
+        if looks_like_js_shell(status, html, markers):
+            raise BrowserRequiredError(f"HTTP {status}, page needs a browser")
+        if not process:
+            # Raw page only, markdown is generated later if it is ever needed
+            from crawl4ai.models import CrawlResult
+
+            return CrawlResult(url=url, html=html, success=True)
+        return await to_thread(process_html, url, html, config)
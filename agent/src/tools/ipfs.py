@@ -0,0 +1,236 @@
+from asyncio import (
+    AbstractEventLoop,
+    Lock,
+    Semaphore,
+    Task,
+    create_task,
+    get_running_loop,
+    sleep,
+    wait_for,
+)
+from contextlib import asynccontextmanager, suppress
+from logging import getLogger
+from os import getenv, path
+from typing import Any, AsyncIterator, Awaitable, Callable, TypeVar
+
+import coloredlogs
+
+coloredlogs.install()
+logger = getLogger("ipfs")
+
+from aiohttp import ClientError
+from aioipfs import APIError, AsyncIPFS, IPFSConnectionError
+
+IPFS_HOST = getenv("IPFS_HOST", "ipfs-node")
+IPFS_PORT = int(getenv("IPFS_PORT", "5001"))
+# Worth another attempt, API errors are answers from the node and are not
+TRANSIENT_ERRORS = (ClientError, IPFSConnectionError, TimeoutError)
+
+T = TypeVar("T")
+
+
+class IpfsError(Exception):
+    pass
+
+
+class IpfsPool:
+    def __init__(
+        self,
+        host: str = IPFS_HOST,
+        port: int = IPFS_PORT,
+        max_connections: int = 16,
+        max_adds: int = 2,
+        retries: int = 3,
+        retry_delay: float = 1,
+        probe_interval: float = 30,
+        probe_timeout: float = 5,
+    ):
+        self.host = host
+        self.port = port
+        self.max_connections = max_connections
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.probe_interval = probe_interval
+        self.probe_timeout = probe_timeout
+        self.healthy: bool | None = None
+        self._client: AsyncIPFS | None = None
+        self._loop: AbstractEventLoop | None = None
+        self._lock = Lock()
+        self._adds = Semaphore(max_adds)
+        self._prober: Task | None = None
+
+    def _create_client(self) -> AsyncIPFS:
+        return AsyncIPFS(
+            host=self.host,
+            port=self.port,
+            conns_max=self.max_connections,
+            conns_max_per_host=self.max_connections,
+        )
+
+    async def start(self):
+        async with self._lock:
+            if self._client is None:
+                self._client = self._create_client()
+                self._loop = get_running_loop()
+                self._prober = create_task(self._probe_forever())
+                logger.info("IPFS pool: ready")
+
+    async def close(self):
+        async with self._lock:
+            if self._prober is not None:
+                self._prober.cancel()
+                with suppress(BaseException):
+                    await self._prober
+                self._prober = None
+            if self._client is not None:
+                await self._client.close()
+                self._client, self._loop = None, None
+                logger.info("IPFS pool: closed")
+
+    @asynccontextmanager
+    async def client(self) -> AsyncIterator[AsyncIPFS]:
+        if self._client is None:
+            await self.start()
+        if self._loop is not get_running_loop():
+            # Pooled connections are bound to the loop that opened them
+            async with self._create_client() as client:
+                yield client
+            return
+        yield self._client
+
+    async def probe(self) -> bool:
+        error = None
+        try:
+            async with self.client() as ipfs:
+                # aioipfs answers None instead of raising when unreachable
+                healthy = await wait_for(ipfs.core.id(), self.probe_timeout) is not None
+        except Exception as e:
+            healthy, error = False, e
+        if healthy != self.healthy:
+            if healthy:
+                logger.info(f"IPFS node: up ({self.host}:{self.port})")
+            else:
+                logger.warning(f"IPFS node: down ({self.host}:{self.port}): {error!r}")
+        self.healthy = healthy
+        return healthy
+
+    async def _probe_forever(self):
+        while True:
+            await self.probe()
+            await sleep(self.probe_interval)
+
+    async def _call(self, action: str, call: Callable[[AsyncIPFS], Awaitable[T]]) -> T:
+        error = None
+        for attempt in range(1, self.retries + 1):
+            try:
+                async with self.client() as ipfs:
+                    return await call(ipfs)
+            except APIError as e:
+                raise IpfsError(f"{action} failed: {e.message}") from e
+            except TRANSIENT_ERRORS as e:
+                error = e
+                logger.warning(
+                    f"{action} failed (attempt {attempt}/{self.retries}): {e!r}"
+                )
+                if attempt < self.retries:
+                    await sleep(self.retry_delay * 2 ** (attempt - 1))
+        raise IpfsError(f"{action} failed after {self.retries} attempts: {error!r}")
+
+    async def add(self, file_path: str, **options: Any) -> dict[str, str]:
+        # Returns the CIDs by name, the last entry being the root of the path
+        if not path.exists(file_path):
+            raise FileNotFoundError(f"File not found: {file_path}")
+
+        async def add(ipfs: AsyncIPFS) -> dict[str, str]:
+            files = {}
+            async for added in ipfs.add(file_path, **options):
+                files[added["Name"]] = added["Hash"]
+                logger.info(f"File added/pinned: {added}")
+            if not files:
+                raise IPFSConnectionError("The node returned no CID")
+            return files
+
+        async with self._adds:
+            return await self._call(f"Adding {file_path}", add)
+
+    async def is_pinned(self, cid: str) -> bool:
+        async def pin_ls(ipfs: AsyncIPFS) -> bool:
+            try:
+                pins = await ipfs.pin.ls(path=cid, pintype="recursive", quiet=True)
+            except APIError as e:
+                # "path '<cid>' is not pinned", or the legacy wording
+                if "not pinned" in (e.message or "").lower():
+                    return False
+                raise
+            if pins is None:
+                raise IPFSConnectionError("No answer from the node")
+            return cid in pins.get("Keys", {})
+
+        return await self._call(f"Checking the pin of {cid}", pin_ls)
+
+    async def copy_to_mfs(self, cid: str, destination: str, parents: bool = False):
+        async def files_cp(ipfs: AsyncIPFS):
+            try:
+                await ipfs.files.cp(f"/ipfs/{cid}", destination, parents=parents)
+            except APIError as e:
+                if "already has entry" not in (e.message or ""):
+                    raise
+
+        await self._call(f"Copying {cid} to {destination}", files_cp)
+
+    async def mfs_cid(self, mfs_path: str) -> str:
+        async def files_stat(ipfs: AsyncIPFS) -> str:
+            stat = await ipfs.files.stat(mfs_path)
+            if stat is None:
+                raise IPFSConnectionError("No answer from the node")
+            return stat["Hash"]
+
+        return await self._call(f"Reading the CID of {mfs_path}", files_stat)
+
+    async def pin(self, cid: str):
+        async def pin_add(ipfs: AsyncIPFS):
+            async for _ in ipfs.pin.add(cid, progress=False):
+                pass
+
+        await self._call(f"Pinning {cid}", pin_add)
+
+    async def unpin(self, cid: str):
+        async def pin_rm(ipfs: AsyncIPFS):
+            try:
+                unpinned = await ipfs.pin.rm(cid)
+            except APIError as e:
+                if "not pinned" in (e.message or "").lower():
+                    return
+                raise
+            if unpinned is None:
+                raise IPFSConnectionError("No answer from the node")
+
+        await self._call(f"Unpinning {cid}", pin_rm)
+
+    async def remove_from_mfs(self, mfs_path: str):
+        async def files_rm(ipfs: AsyncIPFS):
+            try:
+                await ipfs.files.rm(mfs_path, recursive=True)
+            except APIError as e:
+                if "does not exist" not in (e.message or ""):
+                    raise
+
+        await self._call(f"Removing {mfs_path} from MFS", files_rm)
+
+    async def collect_garbage(self) -> int:
+        # Also drops the filestore entries of unpinned nocopy files, a later
+        # add of the same content would otherwise point to the deleted files
+        async def repo_gc(ipfs: AsyncIPFS) -> int:
+            removed = 0
+            async for entry in ipfs.repo.gc(quiet=True):
+                removed += "Key" in entry
+            return removed
+
+        return await self._call("Collecting garbage", repo_gc)
+
+
+ipfs_pool = IpfsPool(
+    max_adds=int(getenv("IPFS_MAX_ADDS", "2")),
+    retries=int(getenv("IPFS_RETRIES", "3")),
+    probe_interval=float(getenv("IPFS_PROBE_INTERVAL", "30")),
+)
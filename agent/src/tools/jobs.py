@@ -0,0 +1,378 @@
+from asyncio import CancelledError, Task, create_task, gather, sleep
+from contextlib import asynccontextmanager
+from json import dumps, loads
+from logging import getLogger
+from os import getpid, makedirs, path
+from time import time
+from typing import Any, AsyncIterator, Awaitable, Callable
+from uuid import uuid4
+
+import coloredlogs
+
+coloredlogs.install()
+logger = getLogger("jobs")
+
+from aiosqlite import Connection, IntegrityError, Row, connect
+
+FINAL_STATUSES = ("done", "failed", "interrupted")
+# Left behind by a graceful shutdown, picked up again by the next start
+SHUTDOWN_ERROR = "Interrupted by a shutdown"
+# Statuses holding a download slot, jobs move on to "adding" once downloaded
+RUNNING_STATUSES = ("starting", "metadata", "downloading")
+JSON_FIELDS = ("progress", "result")
+
+Reporter = Callable[[str, dict | None], Awaitable[None]]
+
+
+class JobStore:
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._initialized = False
+
+    @asynccontextmanager
+    async def _connect(self) -> AsyncIterator[Connection]:
+        if not self._initialized:
+            makedirs(path.dirname(self.db_path), exist_ok=True)
+        async with connect(self.db_path, timeout=10) as db:
+            db.row_factory = Row
+            if not self._initialized:
+                await self._init(db)
+            yield db
+
+    async def _init(self, db: Connection):
+        await db.execute("PRAGMA journal_mode=WAL")
+        await db.execute(
+            "CREATE TABLE IF NOT EXISTS download_jobs ("
+            "id TEXT PRIMARY KEY, status TEXT NOT NULL, "
+            "filename TEXT NOT NULL, magnet_link TEXT NOT NULL, infohash TEXT, "
+            "target TEXT, progress TEXT, result TEXT, error TEXT, pid INTEGER, "
+            "created_at REAL NOT NULL, updated_at REAL NOT NULL)"
+        )
+        async with db.execute("PRAGMA table_info(download_jobs)") as cursor:
+            columns = {row["name"] for row in await cursor.fetchall()}
+        if "target" not in columns:
+            await db.execute("ALTER TABLE download_jobs ADD COLUMN target TEXT")
+        await db.execute(
+            "CREATE INDEX IF NOT EXISTS download_jobs_status "
+            "ON download_jobs (status, updated_at)"
+        )
+        # At most one active job per torrent file, duplicate requests attach to it
+        await db.execute("DROP INDEX IF EXISTS download_jobs_active_infohash")
+        await db.execute(
+            "CREATE UNIQUE INDEX IF NOT EXISTS download_jobs_active_target "
+            "ON download_jobs (infohash, IFNULL(target, '')) WHERE status NOT IN "
+            f"({', '.join(repr(status) for status in FINAL_STATUSES)})"
+        )
+        await db.commit()
+        self._initialized = True
+
+    @staticmethod
+    def _to_job(row: Row) -> dict[str, Any]:
+        job = dict(row)
+        for field in JSON_FIELDS:
+            job[field] = loads(job[field]) if job[field] else None
+        return job
+
+    async def create(self, stale_after: float, **fields) -> tuple[dict[str, Any], bool]:
+        # Returns the job and whether it was created, or the active job it
+        # was attached to
+        now = time()
+        job = dict(
+            id=uuid4().hex,
+            status="queued",
+            pid=getpid(),
+            created_at=now,
+            updated_at=now,
+            **fields,
+        )
+        async with self._connect() as db:
+            for _ in range(2):
+                try:
+                    await db.execute(
+                        f"INSERT INTO download_jobs ({', '.join(job)}) "
+                        f"VALUES ({', '.join('?' * len(job))})",
+                        tuple(job.values()),
+                    )
+                    await db.commit()
+                    break
+                except IntegrityError:
+                    async with db.execute(
+                        "SELECT * FROM download_jobs WHERE infohash = ? "
+                        "AND IFNULL(target, '') = IFNULL(?, '') "
+                        f"AND status NOT IN ({', '.join('?' * len(FINAL_STATUSES))})",
+                        (job["infohash"], job.get("target"), *FINAL_STATUSES),
+                    ) as cursor:
+                        active = await cursor.fetchone()
+                    if active is None:
+                        continue
+                    if active["updated_at"] > now - stale_after:
+                        return self._to_job(active), False
+                    # Left behind by a dead process
+                    await db.execute(
+                        "UPDATE download_jobs SET status = 'interrupted', "
+                        "error = 'Interrupted by a restart', updated_at = ? "
+                        "WHERE id = ?",
+                        (now, active["id"]),
+                    )
+                    await db.commit()
+            else:
+                # Another process keeps taking the torrent over in between
+                raise RuntimeError(f"Could not queue the download of {job['infohash']}")
+        return await self.get(job["id"]), True
+
+    async def update(self, job_id: str, **fields):
+        fields = {
+            name: dumps(value) if name in JSON_FIELDS else value
+            for name, value in fields.items()
+        }
+        fields["updated_at"] = time()
+        async with self._connect() as db:
+            await db.execute(
+                f"UPDATE download_jobs SET {', '.join(f'{name} = ?' for name in fields)} "
+                "WHERE id = ?",
+                (*fields.values(), job_id),
+            )
+            await db.commit()
+
+    async def get(self, job_id: str) -> dict[str, Any] | None:
+        async with self._connect() as db:
+            async with db.execute(
+                "SELECT * FROM download_jobs WHERE id = ?", (job_id,)
+            ) as cursor:
+                row = await cursor.fetchone()
+        return self._to_job(row) if row else None
+
+    async def claim(self, job_id: str, max_running: int, stale_after: float) -> bool:
+        # Atomically takes one of the max_running download slots shared by all
+        # processes, in submission order
+        stale = time() - stale_after
+        running = ", ".join("?" * len(RUNNING_STATUSES))
+        async with self._connect() as db:
+            cursor = await db.execute(
+                "UPDATE download_jobs SET status = 'starting', updated_at = ? "
+                "WHERE id = ? AND status = 'queued' AND ("
+                f"SELECT COUNT(*) FROM download_jobs WHERE status IN ({running}) "
+                "AND updated_at > ?) < ? AND NOT EXISTS ("
+                "SELECT 1 FROM download_jobs AS older WHERE older.status = 'queued' "
+                "AND older.updated_at > ? AND older.created_at < ("
+                "SELECT created_at FROM download_jobs WHERE id = ?))",
+                (time(), job_id, *RUNNING_STATUSES, stale, max_running, stale, job_id),
+            )
+            await db.commit()
+            return cursor.rowcount == 1
+
+    async def running(self, stale_after: float) -> list[dict[str, Any]]:
+        async with self._connect() as db:
+            async with db.execute(
+                "SELECT * FROM download_jobs WHERE status IN "
+                f"({', '.join('?' * len(RUNNING_STATUSES))}) AND updated_at > ?",
+                (*RUNNING_STATUSES, time() - stale_after),
+            ) as cursor:
+                return [self._to_job(row) for row in await cursor.fetchall()]
+
+    async def active(self, stale_after: float) -> list[dict[str, Any]]:
+        # Every live job, queued and adding ones included
+        async with self._connect() as db:
+            async with db.execute(
+                "SELECT * FROM download_jobs WHERE status NOT IN "
+                f"({', '.join('?' * len(FINAL_STATUSES))}) AND updated_at > ?",
+                (*FINAL_STATUSES, time() - stale_after),
+            ) as cursor:
+                return [self._to_job(row) for row in await cursor.fetchall()]
+
+    async def recover(self, stale_after: float, max_age: float) -> list[dict[str, Any]]:
+        # Takes over the jobs of dead or stopped processes, queued again in
+        # their original order. Each one is taken by a single process: the
+        # update only matches the version of the row that was read
+        now = time()
+        async with self._connect() as db:
+            async with db.execute(
+                "SELECT * FROM download_jobs WHERE updated_at > ? AND ("
+                f"(status NOT IN ({', '.join('?' * len(FINAL_STATUSES))}) "
+                "AND updated_at < ?) OR (status = 'interrupted' AND error = ?)) "
+                "ORDER BY created_at",
+                (now - max_age, *FINAL_STATUSES, now - stale_after, SHUTDOWN_ERROR),
+            ) as cursor:
+                orphans = [self._to_job(row) for row in await cursor.fetchall()]
+            recovered = []
+            for job in orphans:
+                progress = dict(job["progress"] or {}, recovered=True)
+                try:
+                    cursor = await db.execute(
+                        "UPDATE download_jobs SET status = 'queued', error = NULL, "
+                        "pid = ?, progress = ?, updated_at = ? "
+                        "WHERE id = ? AND status = ? AND updated_at = ?",
+                        (
+                            getpid(),
+                            dumps(progress),
+                            time(),
+                            job["id"],
+                            job["status"],
+                            job["updated_at"],
+                        ),
+                    )
+                except IntegrityError:
+                    # Requested again in the meantime, the new job does the work
+                    cursor = await db.execute(
+                        "UPDATE download_jobs SET status = 'interrupted', "
+                        "error = 'Interrupted by a restart', updated_at = ? "
+                        "WHERE id = ? AND updated_at = ?",
+                        (time(), job["id"], job["updated_at"]),
+                    )
+                    await db.commit()
+                    continue
+                await db.commit()
+                if cursor.rowcount == 1:
+                    recovered.append(await self.get(job["id"]))
+            return recovered
+
+    async def interrupt_stale(self, max_age: float) -> int:
+        # Running jobs report progress every few seconds, silent ones were
+        # left behind by a process that died
+        async with self._connect() as db:
+            cursor = await db.execute(
+                "UPDATE download_jobs SET status = 'interrupted', "
+                "error = 'Interrupted by a restart', updated_at = ? "
+                f"WHERE status NOT IN ({', '.join('?' * len(FINAL_STATUSES))}) "
+                "AND updated_at < ?",
+                (time(), *FINAL_STATUSES, time() - max_age),
+            )
+            await db.commit()
+            return cursor.rowcount
+
+
+class JobQueue:
+    def __init__(
+        self,
+        store: JobStore,
+        handler: Callable[[dict[str, Any], Reporter], Awaitable[dict]],
+        max_running: int = 3,
+        admit: Callable[[dict[str, Any]], Awaitable[str | None]] | None = None,
+        poll_interval: float = 1,
+        stale_after: float = 60,
+        resume_max_age: float = 86400,
+    ):
+        self.store = store
+        self.handler = handler
+        self.max_running = max_running
+        self.admit = admit  # Returns why the job has to wait, if it does
+        self.poll_interval = poll_interval
+        self.stale_after = stale_after
+        self.resume_max_age = resume_max_age  # Older orphans are not resumed
+        self._tasks: dict[str, Task] = {}
+        self._recovery: Task | None = None
+
+    async def start(self):
+        # Jobs orphaned by a crash only look so once stale, the other
+        # processes of the server keep looking for them
+        await self.recover()
+        interrupted = await self.store.interrupt_stale(self.resume_max_age)
+        if interrupted:
+            logger.warning(f"Marked {interrupted} orphaned job(s) as interrupted")
+        if self._recovery is None:
+            self._recovery = create_task(self._recover_forever())
+        logger.info("Job queue: ready")
+
+    async def close(self):
+        if self._recovery is not None:
+            self._recovery.cancel()
+            self._recovery = None
+        tasks = dict(self._tasks)
+        for task in tasks.values():
+            task.cancel()
+        # Lets the handlers clean up (torrents save their resume data)
+        await gather(*tasks.values(), return_exceptions=True)
+        for job_id in tasks:
+            await self.store.update(job_id, status="interrupted", error=SHUTDOWN_ERROR)
+        self._tasks.clear()
+        logger.info("Job queue: closed")
+
+    async def recover(self) -> int:
+        recovered = await self.store.recover(self.stale_after, self.resume_max_age)
+        for job in recovered:
+            self._tasks[job["id"]] = create_task(self._run(job, recovered=True))
+            logger.warning(f"Job {job['id']} recovered: {job['filename']}")
+        return len(recovered)
+
+    async def _recover_forever(self):
+        while True:
+            await sleep(self.stale_after)
+            try:
+                await self.recover()
+            except Exception as e:
+                logger.error(f"Job recovery failed: {e}")
+
+    async def submit(self, result: dict | None = None, **fields) -> dict[str, Any]:
+        # A result means there is nothing left to do, the job is recorded as done
+        job, created = await self.store.create(self.stale_after, **fields)
+        if not created:
+            logger.info(f"Attached to active job {job['id']}: {job['filename']}")
+            return job
+        if result is not None:
+            await self.store.update(job["id"], status="done", result=result)
+            return await self.store.get(job["id"])
+        self._tasks[job["id"]] = create_task(self._run(job))
+        logger.info(f"Job {job['id']} queued: {job['filename']}")
+        return job
+
+    async def _wait_for_slot(self, job: dict[str, Any]):
+        while True:
+            reason = await self.admit(job) if self.admit else None
+            if reason is None and await self.store.claim(
+                job["id"], self.max_running, self.stale_after
+            ):
+                return
+            # Also keeps the job from looking orphaned while it waits
+            await self.store.update(
+                job["id"], progress=dict(waiting=reason or "Waiting for a free slot")
+            )
+            await sleep(self.poll_interval)
+
+    async def _heartbeat(self, job_id: str):
+        # Keeps long silent steps (adding to IPFS) from looking orphaned
+        while True:
+            await sleep(self.stale_after / 3)
+            await self.store.update(job_id)
+
+    async def _run(self, job: dict[str, Any], recovered: bool = False):
+        job_id = job["id"]
+
+        async def report(status: str, progress: dict | None = None):
+            if progress is None:
+                await self.store.update(job_id, status=status)
+            else:
+                if recovered:
+                    progress = dict(progress, recovered=True)
+                await self.store.update(job_id, status=status, progress=progress)
+
+        heartbeat = create_task(self._heartbeat(job_id))
+        try:
+            await self._wait_for_slot(job)
+            result = await self.handler(job, report)
+            await self.store.update(job_id, status="done", result=result)
+            logger.info(f"Job {job_id} done")
+        except CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Job {job_id} failed: {e}")
+            await self.store.update(job_id, status="failed", error=str(e))
+        finally:
+            heartbeat.cancel()
+            self._tasks.pop(job_id, None)
+
+    async def get(self, job_id: str) -> dict[str, Any] | None:
+        return await self.store.get(job_id)
+
+    async def watch(self, job_id: str) -> AsyncIterator[dict[str, Any]]:
+        # Polls the store so jobs running in any server process can be followed
+        last_update = None
+        while True:
+            job = await self.store.get(job_id)
+            if job is None:
+                return
+            if job["updated_at"] != last_update:
+                last_update = job["updated_at"]
+                yield job
+            if job["status"] in FINAL_STATUSES:
+                return
+            await sleep(self.poll_interval)
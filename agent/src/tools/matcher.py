@@ -0,0 +1,90 @@
+import re
+from difflib import SequenceMatcher
+from os import path
+
+VIDEO_EXTENSIONS = {
+    ".mkv",
+    ".mp4",
+    ".avi",
+    ".mov",
+    ".wmv",
+    ".m4v",
+    ".webm",
+    ".ts",
+    ".m2ts",
+    ".flv",
+    ".mpg",
+    ".mpeg",
+}
+EXTRAS = re.compile(
+    r"\b(sample|trailer|extras?|featurettes?|bonus|preview|behind.the.scenes|"
+    r"deleted.scenes|interviews?|ncop|nced)\b",
+    re.IGNORECASE,
+)
+EPISODE = re.compile(
+    r"\bs(\d{1,2})\s*e(\d{1,3})\b|\b(\d{1,2})x(\d{2,3})\b", re.IGNORECASE
+)
+TOKENS = re.compile(r"[a-z0-9]+")
+
+# Above the margin, the best file wins without asking the LLM
+AMBIGUITY_MARGIN = 0.75
+WEIGHTS = dict(
+    tokens=3.0, similarity=1.0, size=1.5, video=2.0, extras=-3.0, episode=3.0
+)
+
+
+def episode_of(text: str) -> tuple[int, int] | None:
+    match = EPISODE.search(text)
+    if not match:
+        return None
+    season, episode = match.group(1, 2) if match.group(1) else match.group(3, 4)
+    return int(season), int(episode)
+
+
+def normalize(text: str) -> str:
+    return " ".join(TOKENS.findall(text.lower()))
+
+
+def score_file(target: str, file_path: str, size: int, max_size: int) -> float:
+    name = path.basename(file_path)
+    target_tokens = set(TOKENS.findall(target.lower()))
+    # Parent dirs count for the tokens, season packs name them after the show
+    file_tokens = set(TOKENS.findall(file_path.lower()))
+    value = WEIGHTS["tokens"] * (
+        len(target_tokens & file_tokens) / len(target_tokens) if target_tokens else 0
+    )
+    value += (
+        WEIGHTS["similarity"]
+        * SequenceMatcher(
+            None, normalize(target), normalize(path.splitext(name)[0])
+        ).ratio()
+    )
+    value += WEIGHTS["size"] * (size / max_size if max_size else 0)
+    if path.splitext(name)[1].lower() in VIDEO_EXTENSIONS:
+        value += WEIGHTS["video"]
+    if EXTRAS.search(file_path) and not EXTRAS.search(target):
+        value += WEIGHTS["extras"]
+    wanted = episode_of(target)
+    if wanted:
+        found = episode_of(name)
+        if found:
+            value += WEIGHTS["episode"] if found == wanted else -WEIGHTS["episode"]
+    return round(value, 3)
+
+
+def match_files(target: str, file_paths: list[str], sizes: list[int]) -> list[dict]:
+    # Best first, with the scores kept for debugging
+    max_size = max(sizes, default=0)
+    matches = [
+        dict(
+            path=file_path,
+            size=size,
+            score=score_file(target, file_path, size, max_size),
+        )
+        for file_path, size in zip(file_paths, sizes)
+    ]
+    return sorted(matches, key=lambda match: match["score"], reverse=True)
+
+
+def is_ambiguous(matches: list[dict], margin: float = AMBIGUITY_MARGIN) -> bool:
+    return len(matches) > 1 and matches[0]["score"] - matches[1]["score"] < margin
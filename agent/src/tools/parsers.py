@@ -0,0 +1,104 @@
+import re
+from logging import getLogger
+
+import coloredlogs
+
+coloredlogs.install()
+logger = getLogger("parsers")
+
+from lxml.etree import XPath
+from lxml.html import HtmlElement, document_fromstring
+
+# Parsers walk the raw page DOM and return torrent dicts (without website_source),
+# or None when the page layout is not recognized so the caller can fall back
+# to the markdown -> CSV extraction
+
+SIZE_UNIT = re.compile(r"([\d.]+)\s?([KMGT])i?B")
+MAGNET_LINKS = XPath('.//a[starts-with(@href, "magnet:")]/@href')
+NYAA_ROWS = XPath(
+    '//table[contains(concat(" ", normalize-space(@class), " "), " torrent-list ")]'
+    "/tbody/tr"
+)
+THEPIRATEBAY_ROWS = XPath(
+    '//li[contains(concat(" ", normalize-space(@class), " "), " list-entry ")]'
+)
+
+
+def text_of(element: HtmlElement | None) -> str:
+    return " ".join("".join(element.itertext()).split()) if element is not None else ""
+
+
+def normalize_size(size: str) -> str:
+    return SIZE_UNIT.sub(r"\1 \2B", " ".join(size.split()))
+
+
+def to_int(value: str) -> int:
+    return int(value.replace(",", "") or 0)
+
+
+def no_results(html: str, torrents: list[dict], marker: str) -> list[dict] | None:
+    if torrents or marker in html:
+        return torrents
+    return None
+
+
+def parse_nyaa(html: str) -> list[dict] | None:
+    torrents = []
+    for row in NYAA_ROWS(document_fromstring(html)):
+        cells = row.findall("td")
+        if len(cells) < 8:
+            continue
+        names = [
+            link
+            for link in cells[1].findall("a")
+            if "comments" not in (link.get("class") or "")
+        ]
+        magnets = MAGNET_LINKS(cells[2])
+        if not names or not magnets:
+            continue
+        category = cells[0].find("a")
+        torrents.append(
+            dict(
+                category=category.get("title") if category is not None else None,
+                filename=names[-1].get("title") or text_of(names[-1]),
+                magnet_link=magnets[0],
+                size=normalize_size(text_of(cells[3])),
+                date=text_of(cells[4]),
+                seeders=to_int(text_of(cells[5])),
+                leechers=to_int(text_of(cells[6])),
+                downloads=to_int(text_of(cells[7])),
+            )
+        )
+    return no_results(html, torrents, "No results found")
+
+
+def parse_thepiratebay(html: str) -> list[dict] | None:
+    torrents = []
+    for row in THEPIRATEBAY_ROWS(document_fromstring(html)):
+        spans = {}
+        for span in row.iterfind("span"):
+            for name in (span.get("class") or "").split():
+                spans.setdefault(name, span)
+        title, icons = spans.get("item-title"), spans.get("item-icons")
+        magnets = MAGNET_LINKS(icons) if icons is not None else []
+        if title is None or not magnets:
+            continue
+        category = spans.get("item-type")
+        torrents.append(
+            dict(
+                category=(
+                    " - ".join(text_of(link) for link in category.iterfind("a"))
+                    or text_of(category)
+                    if category is not None
+                    else None
+                ),
+                filename=text_of(title),
+                date=text_of(spans.get("item-uploaded")),
+                magnet_link=magnets[0],
+                size=normalize_size(text_of(spans.get("item-size"))),
+                seeders=to_int(text_of(spans.get("item-seed"))),
+                leechers=to_int(text_of(spans.get("item-leech"))),
+                uploader=text_of(spans.get("item-user")) or None,
+            )
+        )
+    return no_results(html, torrents, "No results returned")
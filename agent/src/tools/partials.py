@@ -0,0 +1,21 @@
+import re
+from contextvars import ContextVar
+from typing import Callable
+
+PARTIAL_TAG = re.compile(r"^<tool-[\w-]+-partial>")
+
+# Set by the agent for the duration of a streamed turn, tools (even running in
+# a worker thread with their own event loop) forward partial results through it
+partial_messages: ContextVar[Callable[[str], None] | None] = ContextVar(
+    "partial_messages", default=None
+)
+
+
+def send_partial(tag: str, content: str):
+    forward = partial_messages.get()
+    if forward is not None:
+        forward(f"<tool-{tag}-partial>{content}</tool-{tag}-partial>")
+
+
+def is_partial(message: str) -> bool:
+    return PARTIAL_TAG.match(message) is not None
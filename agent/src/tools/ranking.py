@@ -0,0 +1,103 @@
+import re
+from heapq import nlargest
+from math import log2
+from typing import Any, Iterable
+
+SIZE = re.compile(r"([\d.,]+)\s*([KMGT]?)i?B", re.IGNORECASE)
+SIZE_UNITS = {"": 1, "K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+RESOLUTION = re.compile(r"\b(2160|1080|720|576|480)[pi]\b|\b(4k|uhd)\b", re.IGNORECASE)
+CODECS = {
+    "x265": re.compile(r"\b(x|h)\.?265\b|\bhevc\b", re.IGNORECASE),
+    "av1": re.compile(r"\bav1\b", re.IGNORECASE),
+    "x264": re.compile(r"\b(x|h)\.?264\b|\bavc\b", re.IGNORECASE),
+}
+MEDIA_SOURCES = {
+    "cam": re.compile(r"\b(hd)?(cam|ts|telesync|tc)(rip)?\b", re.IGNORECASE),
+    "bluray": re.compile(r"\b(blu-?ray|bdrip|brrip|bdremux|remux)\b", re.IGNORECASE),
+    "web": re.compile(r"\bweb(-?dl|-?rip)?\b", re.IGNORECASE),
+    "hdtv": re.compile(r"\bhdtv(rip)?\b", re.IGNORECASE),
+    "dvd": re.compile(r"\bdvd(rip|scr|5|9)?\b", re.IGNORECASE),
+}
+
+# Peers weigh on a log scale, the size weight applies to log2(size in GiB)
+DEFAULT_SCORING = dict(
+    seeders=1.0,
+    leechers=0.25,
+    size=-0.5,
+    resolutions={2160: 2.5, 1080: 3.0, 720: 1.0, 576: 0.0, 480: -1.0},
+    codecs={"x264": 0.5, "x265": -2.0, "av1": -2.0},
+    media_sources={"bluray": 1.0, "web": 1.0, "hdtv": 0.0, "dvd": -0.5, "cam": -5.0},
+)
+
+
+def parse_size(size: str | None) -> int | None:
+    match = SIZE.search(size or "")
+    if not match:
+        return None
+    value, unit = match.groups()
+    try:
+        return int(float(value.replace(",", "")) * SIZE_UNITS[unit.upper()])
+    except ValueError:
+        return None
+
+
+def parse_resolution(filename: str) -> int | None:
+    match = RESOLUTION.search(filename)
+    if not match:
+        return None
+    return int(match.group(1)) if match.group(1) else 2160
+
+
+def parse_tag(filename: str, patterns: dict[str, re.Pattern]) -> str | None:
+    return next(
+        (tag for tag, pattern in patterns.items() if pattern.search(filename)), None
+    )
+
+
+def to_int(value: Any) -> int:
+    try:
+        return int(str(value).replace(",", "").strip() or 0)
+    except ValueError:
+        return 0
+
+
+def annotate(torrent: dict):
+    # Parses the typed fields once, ranking again later only recomputes the score
+    filename = torrent.get("filename", "")
+    torrent["seeders"] = to_int(torrent.get("seeders"))
+    torrent["leechers"] = to_int(torrent.get("leechers"))
+    if torrent.get("downloads") is not None:
+        torrent["downloads"] = to_int(torrent["downloads"])
+    torrent["size_bytes"] = parse_size(torrent.get("size"))
+    torrent["resolution"] = parse_resolution(filename)
+    torrent["codec"] = parse_tag(filename, CODECS)
+    torrent["media_source"] = parse_tag(filename, MEDIA_SOURCES)
+
+
+def score(torrent: dict, scoring: dict[str, Any]) -> float:
+    value = scoring["seeders"] * log2(1 + torrent["seeders"])
+    value += scoring["leechers"] * log2(1 + torrent["leechers"])
+    if torrent["size_bytes"]:
+        value += scoring["size"] * log2(max(torrent["size_bytes"] / 1024**3, 0.01))
+    value += scoring["resolutions"].get(torrent["resolution"], 0.0)
+    value += scoring["codecs"].get(torrent["codec"], 0.0)
+    value += scoring["media_sources"].get(torrent["media_source"], 0.0)
+    return round(value, 2)
+
+
+def rank_torrents(
+    torrents: Iterable[dict],
+    max_items=20,
+    min_peers=0,
+    scoring: dict[str, Any] | None = None,
+) -> list[dict]:
+    scoring = scoring or DEFAULT_SCORING
+    candidates = []
+    for torrent in torrents:
+        if "size_bytes" not in torrent:
+            annotate(torrent)
+        if torrent["seeders"] + torrent["leechers"] < min_peers:
+            continue
+        torrent["score"] = score(torrent, scoring)
+        candidates.append(torrent)
+    return nlargest(max_items, candidates, key=lambda torrent: torrent["score"])
@@ -1,10 +1,24 @@
+from __future__ import annotations
+
 import re
-from asyncio import run
+from asyncio import (
+    FIRST_COMPLETED,
+    AbstractEventLoop,
+    Semaphore,
+    create_task,
+    gather,
+    get_running_loop,
+    to_thread,
+    wait,
+    wait_for,
+)
+from functools import cache, partial
 from json import dumps, loads
 from logging import getLogger
-from os import getenv
+from operator import methodcaller
+from os import getenv, path
 from time import time
-from typing import Any
+from typing import TYPE_CHECKING, Any, AsyncIterator, Callable
 from urllib.parse import quote
 
 import coloredlogs
@@ -17,34 +31,63 @@ logger = getLogger("scraper")
 
 
 from coinbase_agentkit import ActionProvider, WalletProvider, create_action
-from crawl4ai import AsyncWebCrawler, CacheMode
-from crawl4ai.async_configs import BrowserConfig, CrawlerRunConfig
-from crawl4ai.markdown_generation_strategy import DefaultMarkdownGenerator
-from openai import OpenAI
-
-# Module-level configurations for AsyncWebCrawler
-BROWSER_CONFIG = BrowserConfig(
-    browser_type="chromium",
-    headless=True,
-    text_mode=True,
-    light_mode=True,
-)
-DEFAULT_MD_GENERATOR = DefaultMarkdownGenerator(
-    options=dict(
-        ignore_images=True,
-        ignore_links=False,
-        skip_internal_links=True,
-        escape_html=True,
+
+from .browser import BrowserPool
+from .cache import SearchCache
+from .fetcher import BrowserRequiredError, HttpPool, process_html
+from .parsers import parse_nyaa, parse_thepiratebay
+from .partials import send_partial
+from .ranking import rank_torrents
+from .singleflight import SingleFlight
+
+if TYPE_CHECKING:
+    from crawl4ai.async_configs import BrowserConfig, CrawlerRunConfig
+    from crawl4ai.models import CrawlResult
+    from openai import AsyncOpenAI
+
+
+# Configurations for AsyncWebCrawler, crawl4ai only loads on the first scrape
+@cache
+def browser_config() -> BrowserConfig:
+    from crawl4ai.async_configs import BrowserConfig
+
+    return BrowserConfig(
+        browser_type="chromium",
+        headless=True,
+        text_mode=True,
+        light_mode=True,
     )
+
+
+@cache
+def crawler_run_config() -> CrawlerRunConfig:
+    from crawl4ai import CacheMode
+    from crawl4ai.async_configs import CrawlerRunConfig
+    from crawl4ai.markdown_generation_strategy import DefaultMarkdownGenerator
+
+    return CrawlerRunConfig(
+        markdown_generator=DefaultMarkdownGenerator(
+            options=dict(
+                ignore_images=True,
+                ignore_links=False,
+                skip_internal_links=True,
+                escape_html=True,
+            )
+        ),
+        remove_overlay_elements=True,
+        exclude_social_media_links=True,
+        excluded_tags=["header", "footer", "nav"],
+        remove_forms=True,
+        cache_mode=CacheMode.DISABLED,
+    )
+
+
+browser_pool = BrowserPool(
+    browser_config,
+    size=int(getenv("BROWSER_POOL_SIZE", "2")),
+    max_pages=int(getenv("BROWSER_MAX_PAGES", "50")),
 )
-DEFAULT_CRAWLER_RUN_CONFIG = CrawlerRunConfig(
-    markdown_generator=DEFAULT_MD_GENERATOR,
-    remove_overlay_elements=True,
-    exclude_social_media_links=True,
-    excluded_tags=["header", "footer", "nav"],
-    remove_forms=True,
-    cache_mode=CacheMode.DISABLED,
-)
+http_pool = HttpPool()
 
 
 FILTERS = {
@@ -107,19 +150,43 @@ REPLACERS = {
     "to_csv": [re.compile(r" \| *"), ";"],
 }
 
+BLANK_LINES = re.compile(r"\n{2,}")
+INFOHASH = re.compile(r"btih:([0-9a-zA-Z]+)", re.IGNORECASE)
+SHRINK_WINDOW_FACTOR = 4
+# Part of a source timeout given to the plain HTTP fetch, the rest is left
+# to the browser fallback
+HTTP_TIMEOUT_SHARE = 0.5
+
+SCRAPING_TIMEOUT = float(getenv("SCRAPING_TIMEOUT", "30"))
+
 WEBSITES = {
     "thepiratebay.org": dict(
         search="https://thepiratebay.org/search.php?q={query}",
         parsing="html",
+        fetch="browser",
+        parser=parse_thepiratebay,
         exclude_patterns=[],
     ),
     "nyaa.si": dict(
         search="https://nyaa.si/?f=0&c=0_0&q={query}&s=seeders&o=desc",
         parsing="markdown",
+        fetch="http",
+        markers=["torrent-list", "No results found"],
+        parser=parse_nyaa,
         exclude_patterns=["local_links"],
     ),
 }
 
+DATA_DIR = path.join(path.dirname(path.dirname(path.dirname(__file__))), "data")
+search_cache = SearchCache(
+    path.join(DATA_DIR, "database", "cache.sqlite"),
+    ttl=float(getenv("SEARCH_CACHE_TTL", "600")),
+    stale_ttl=float(getenv("SEARCH_CACHE_STALE_TTL", "3600")),
+    negative_ttl=float(getenv("SEARCH_CACHE_NEGATIVE_TTL", "60")),
+    max_entries=int(getenv("SEARCH_CACHE_MAX_ENTRIES", "1000")),
+    flights=SingleFlight(path.join(DATA_DIR, "locks")),
+)
+
 MODELS = dict(
     groq=dict(
         api_url=getenv("GROQ_API_BASE"),
@@ -134,6 +201,14 @@ MODELS = dict(
 )
 
 PARAMS = dict(temperature=0.1, stream=False)
+llm_clients: dict[str, tuple[AbstractEventLoop, AsyncOpenAI]] = {}
+
+# Scraped text kept per source, the LLM path gets more as it is chunked
+MAX_CHARS = 5000
+LLM_MAX_CHARS = int(getenv("LLM_MAX_CHARS", "20000"))
+LLM_CHUNK_TOKENS = int(getenv("LLM_CHUNK_TOKENS", "1500"))
+LLM_MAX_PARALLEL = int(getenv("LLM_MAX_PARALLEL", "4"))
+CHARS_PER_TOKEN = 3
 
 
 class Torrent(BaseModel):
@@ -153,68 +228,199 @@ class Results(BaseModel):
     torrents: list[Torrent]
 
 
+def as_literal(pattern: re.Pattern) -> str | None:
+    literal, escaped = "", False
+    if pattern.flags & re.IGNORECASE:
+        return None
+    for char in pattern.pattern:
+        if escaped:
+            if char.isalnum():
+                return None
+            literal, escaped = literal + char, False
+        elif char == "\\":
+            escaped = True
+        elif char in ".^$*+?{}[]|()":
+            return None
+        else:
+            literal += char
+    return None if escaped else literal
+
+
+def compile_pipeline(exclude_patterns: list[str] | None = None) -> list[Callable]:
+    steps = [
+        (pattern, "")
+        for name, pattern in FILTERS.items()
+        if name not in (exclude_patterns or [])
+    ] + [
+        (pattern, replacement)
+        for name, (pattern, replacement) in REPLACERS.items()
+        if name not in (exclude_patterns or [])
+    ]
+    pipeline = []
+    for pattern, replacement in steps:
+        literal = as_literal(pattern)
+        if literal and "\\" not in replacement:
+            # Plain substrings are much cheaper to replace without the regex engine
+            pipeline.append(methodcaller("replace", literal, replacement))
+        else:
+            pipeline.append(partial(pattern.sub, replacement))
+    return pipeline
+
+
+DEFAULT_PIPELINE = compile_pipeline()
+PIPELINES = {
+    source: compile_pipeline(data.get("exclude_patterns"))
+    for source, data in WEBSITES.items()
+}
+
+
 def shrink_text(
-    text: str, exclude_patterns: list[str] | None = None, max_chars=5000
+    text: str,
+    pipeline: list[Callable] | None = None,
+    max_chars=5000,
 ) -> str:
-    text = text.split("<li>", 1)[-1].replace("<li>", "")
-    for name, pattern in FILTERS.items():
-        if exclude_patterns and name in exclude_patterns:
-            continue
-        text = pattern.sub("", text)
-    for name, replacer_config in REPLACERS.items():
-        if exclude_patterns and name in exclude_patterns:
-            continue
-        pattern, replacement_str = replacer_config
-        text = pattern.sub(replacement_str, text)
+    pipeline = pipeline or DEFAULT_PIPELINE
+    start = text.find("<li>")
+    start = 0 if start == -1 else start + 4
+    # Only clean a line-aligned window that is large enough to fill max_chars
+    # once shrunk (with the same margin again), growing it when it is not
+    window = max_chars * SHRINK_WINDOW_FACTOR
+    while True:
+        end = text.find("\n", start + window)
+        chunk = text[start:] if end == -1 else text[start:end]
+        chunk = chunk.replace("<li>", "")
+        for step in pipeline:
+            chunk = step(chunk)
+        if end == -1 or len(chunk) > 2 * max_chars:
+            break
+        window *= 2
+    text = chunk
     if len(text) > max_chars:
         safe_truncate_pos = text.rfind("\n", 0, max_chars)
         if safe_truncate_pos == -1:
             text = text[:max_chars]
         else:
             text = text[:safe_truncate_pos]
-    text = re.sub(r"\n{2,}", "\n", text)
+    text = BLANK_LINES.sub("\n", text)
     return text.strip()
 
 
-async def scrape_torrents(query: str, sources: list[str] | None = None) -> str:
-    results_list = []
-    async with AsyncWebCrawler(
-        config=BROWSER_CONFIG, always_bypass_cache=True
-    ) as crawler:
-        for source, data in WEBSITES.items():
-            if sources is None or source in sources:
-                url = data["search"].format(query=quote(query))
-                try:
-                    crawl_result = await crawler.arun(
-                        url=url, config=DEFAULT_CRAWLER_RUN_CONFIG
-                    )
-                    processed_text = shrink_text(
-                        (
-                            crawl_result.cleaned_html
-                            if data["parsing"] == "html"
-                            else crawl_result.markdown
-                        ),
-                        data.get("exclude_patterns", []),
-                    )
-                    results_list.append(
-                        f"SCRAPING WEBSITE SOURCE -> {source}:\n{processed_text}"
-                    )
-                except Exception as e:
-                    logger.error(
-                        f"Error scraping {source} for query '{query}' at {url}: {e}"
-                    )
-                    results_list.append(
-                        f"ERROR SCRAPING WEBSITE SOURCE -> {source}: {e}"
-                    )
-    return "\n----------\n".join(results_list)
-
-
-def extract_results_with_llm(text: str, llm: str) -> str:
-    client = OpenAI(
-        base_url=MODELS[llm]["api_url"],
-        api_key=MODELS[llm]["api_token"],
-    )
-    response = client.chat.completions.create(
+async def crawl_source(url: str, data: dict[str, Any]) -> CrawlResult:
+    if data.get("fetch") == "http":
+        try:
+            return await http_pool.crawl(
+                url,
+                crawler_run_config(),
+                markers=data.get("markers"),
+                process="parser" not in data,
+                timeout=data.get("timeout", SCRAPING_TIMEOUT) * HTTP_TIMEOUT_SHARE,
+            )
+        except BrowserRequiredError as e:
+            logger.info(f"Falling back to browser for {url}: {e}")
+        except Exception as e:
+            logger.warning(f"Plain HTTP fetch failed for {url} ({e}), using browser")
+    return await browser_pool.crawl(url=url, config=crawler_run_config())
+
+
+def parse_torrents(source: str, data: dict[str, Any], html: str) -> list[dict] | None:
+    try:
+        parsed = data["parser"](html)
+    except Exception as e:
+        logger.warning(f"Parser failed for {source}, falling back to CSV: {e}")
+        return None
+    if parsed is None:
+        logger.warning(f"Unrecognized page layout for {source}, falling back to CSV")
+        return None
+    torrents = []
+    for torrent in parsed:
+        torrent["website_source"] = source
+        try:
+            Torrent.model_validate(torrent)
+        except ValidationError:
+            continue
+        torrents.append(torrent)
+    return torrents
+
+
+async def scrape_source(
+    query: str, source: str, data: dict[str, Any], max_chars=MAX_CHARS
+) -> tuple[list[dict] | None, str]:
+    # Returns the torrents parsed from the DOM, or None with the shrunk text
+    # section left for CSV/LLM extraction
+    url = data["search"].format(query=quote(query))
+    timeout = data.get("timeout", SCRAPING_TIMEOUT)
+    try:
+        crawl_result = await wait_for(crawl_source(url, data), timeout=timeout)
+        if "parser" in data:
+            torrents = await to_thread(parse_torrents, source, data, crawl_result.html)
+            if torrents is not None:
+                return torrents, ""
+        if crawl_result.cleaned_html is None:
+            crawl_result = await to_thread(
+                process_html, url, crawl_result.html, crawler_run_config()
+            )
+        processed_text = shrink_text(
+            (
+                crawl_result.cleaned_html
+                if data["parsing"] == "html"
+                else crawl_result.markdown
+            ),
+            PIPELINES[source],
+            max_chars=max_chars,
+        )
+        return None, f"SCRAPING WEBSITE SOURCE -> {source}:\n{processed_text}"
+    except TimeoutError:
+        error = f"Timed out after {timeout} sec."
+    except Exception as e:
+        error = str(e)
+    logger.error(f"Error scraping {source} for query '{query}' at {url}: {error}")
+    return None, f"ERROR SCRAPING WEBSITE SOURCE -> {source}: {error}"
+
+
+def llm_client(llm: str) -> AsyncOpenAI:
+    # One client (and connection pool) per LLM and event loop
+    from openai import AsyncOpenAI
+
+    loop = get_running_loop()
+    if llm not in llm_clients or llm_clients[llm][0] is not loop:
+        llm_clients[llm] = (
+            loop,
+            AsyncOpenAI(
+                base_url=MODELS[llm]["api_url"],
+                api_key=MODELS[llm]["api_token"],
+                max_retries=0,
+            ),
+        )
+    return llm_clients[llm][1]
+
+
+def split_chunks(text: str, max_chars: int) -> list[str]:
+    # Packs whole rows into chunks, each one repeating the column header line
+    header, _, body = text.partition("\n")
+    if len(header) > max_chars // 4:
+        header, body = "", text
+    rows = []
+    for line in body.splitlines():
+        while len(line) > max_chars:
+            # Unbroken rows (html parsing) are cut on a column separator
+            cut = line.rfind(";", 0, max_chars) + 1 or max_chars
+            rows.append(line[:cut])
+            line = line[cut:]
+        rows.append(line)
+    chunks, chunk, size = [], [], 0
+    for row in rows:
+        if chunk and size + len(row) > max_chars:
+            chunks.append("\n".join([header, *chunk]).strip())
+            chunk, size = [], 0
+        chunk.append(row)
+        size += len(row) + 1
+    if chunk:
+        chunks.append("\n".join([header, *chunk]).strip())
+    return chunks
+
+
+async def extract_chunk_with_llm(text: str, source: str, llm: str) -> list[dict]:
+    response = await llm_client(llm).chat.completions.create(
         model=MODELS[llm]["model"],
         messages=[
             {
@@ -235,24 +441,46 @@ def extract_results_with_llm(text: str, llm: str) -> str:
         response_format={"type": "json_object"},
         **PARAMS,
     )
-    return response.choices[0].message.content
-
-
-def extract_json_after_llm(text: str) -> list[dict]:
-    return loads("[" + "]".join(text.split("[", 1)[1].split("]")[:-1]) + "]")
-
-
-def extract_with_llm(text: str, llm: str | None) -> list[dict]:
-    if not llm:
-        logger.info("No LLM specified, skipping extraction.")
+    results = loads(response.choices[0].message.content)
+    for torrent in results.get("torrents", []):
+        torrent["website_source"] = source
+    # Raises on any malformed torrent, so the chunk is retried as a whole
+    return [
+        torrent.model_dump(exclude_none=True)
+        for torrent in Results.model_validate(results).torrents
+    ]
+
+
+async def extract_with_llm(text: str, llm: str, max_retries=3) -> list[dict]:
+    heading, content = text.split("\n", 1)
+    source = heading.split("-> ", 1)[1][:-1]
+    limit = Semaphore(LLM_MAX_PARALLEL)
+
+    async def extract(chunk: str) -> list[dict]:
+        for retries in range(1, max_retries + 1):
+            try:
+                async with limit:
+                    return await extract_chunk_with_llm(chunk, source, llm)
+            except Exception as e:
+                logger.error(
+                    f"Attempt {retries}/{max_retries} failed to extract a chunk "
+                    f"from {source}: {e}"
+                )
+        logger.error(f"Max retries reached, skipping a chunk from {source}.")
         return []
-    return extract_json_after_llm(extract_results_with_llm(text, llm=llm))
+
+    chunks = split_chunks(content, LLM_CHUNK_TOKENS * CHARS_PER_TOKEN)
+    results = await gather(*(extract(chunk) for chunk in chunks))
+    logger.info(f"Extracted {source} with {llm} in {len(chunks)} chunk(s)")
+    return [torrent for torrents in results for torrent in torrents]
 
 
 def extract_via_csv(text: str) -> list[dict]:
     by_source = text.split("\n----------\n")
     torrents = []
     for data in by_source:
+        if data.startswith("ERROR SCRAPING") or "\n" not in data:
+            continue
         source, content = data.split("\n", 1)
         if "No results" in content:
             continue
@@ -262,6 +490,8 @@ def extract_via_csv(text: str) -> list[dict]:
         for line in content[1:]:
             row = line.split(";")
             torrent = dict(zip(headers, row))
+            if "link" in torrent:
+                torrent["magnet_link"] = torrent.pop("link")
             torrent["website_source"] = source
             try:
                 Torrent.model_validate(torrent)
@@ -271,18 +501,79 @@ def extract_via_csv(text: str) -> list[dict]:
     return torrents
 
 
-def filtering_results(torrents: dict, min_peers=0, max_items=20) -> list[dict]:
-    return list(
-        sorted(
-            filter(
-                lambda torrent: int(torrent["seeders"]) + int(torrent["leechers"])
-                >= min_peers,
-                torrents,
+async def extract_source(text: str, llm: str | None, max_retries=3) -> list[dict]:
+    if llm:
+        return await extract_with_llm(text, llm, max_retries=max_retries)
+    try:
+        return extract_via_csv(text)
+    except Exception as e:
+        logger.error(f"Failed to extract results: {e}")
+        return []
+
+
+def torrent_key(torrent: dict) -> str:
+    infohash = INFOHASH.search(torrent.get("magnet_link") or "")
+    return infohash.group(1).lower() if infohash else torrent["filename"]
+
+
+async def stream_torrent_list(
+    query: str,
+    sources: list[str] | None = None,
+    llm: str | None = None,
+    max_retries=3,
+) -> AsyncIterator[list[dict]]:
+    # Yields the deduplicated and ranked results so far, each time a source
+    # brings new torrents
+    start_time = time()
+    pending = {
+        create_task(
+            scrape_source(
+                query, source, data, max_chars=LLM_MAX_CHARS if llm else MAX_CHARS
             ),
-            key=lambda torrent: int(torrent["seeders"]) + int(torrent["leechers"]),
-            reverse=True,
+            name=source,
         )
-    )[:max_items]
+        for source, data in WEBSITES.items()
+        if sources is None or source in sources
+    }
+    torrents: dict[str, dict] = {}
+    try:
+        while pending:
+            done, pending = await wait(pending, return_when=FIRST_COMPLETED)
+            added = 0
+            for task in done:
+                parsed, text = task.result()
+                if parsed is None and not text.startswith("ERROR SCRAPING"):
+                    # Sources without a DOM parser (or whose parser failed)
+                    parsed = await extract_source(text, llm, max_retries)
+                for torrent in parsed or []:
+                    key = torrent_key(torrent)
+                    if key not in torrents:
+                        torrents[key] = torrent
+                        added += 1
+                logger.info(
+                    f"{task.get_name()}: {len(parsed or [])} results "
+                    f"after {time() - start_time:.2f} sec."
+                )
+            if added:
+                yield rank_torrents(torrents.values())
+    finally:
+        for task in pending:
+            task.cancel()
+    logger.info(f"Successfully extracted results in {time() - start_time:.2f} sec.")
+
+
+async def search_torrent_list(
+    query: str,
+    sources: list[str] | None = None,
+    llm: str | None = None,
+    max_retries=3,
+    on_results: Callable[[list[dict]], None] | None = None,
+) -> list[dict]:
+    results = []
+    async for results in stream_torrent_list(query, sources, llm, max_retries):
+        if on_results:
+            on_results(results)
+    return results
 
 
 async def find_torrent_list(
@@ -290,37 +581,22 @@ async def find_torrent_list(
     sources: list[str] | None = None,
     llm: str | None = None,
     max_retries=3,
+    use_cache=True,
+    on_results: Callable[[list[dict]], None] | None = None,
 ) -> list[dict]:
-    start_time = time()
-    results = await scrape_torrents(query, sources=sources)
-    retries = 0
-    while retries < max_retries:
-        try:
-            extracted_data = None
-            if llm:
-                extracted_data = extract_with_llm(results, llm=llm)
-            else:
-                extracted_data = extract_via_csv(results)
-            extracted_data = filtering_results(extracted_data)
-            logger.info(
-                f"Successfully extracted results in {time() - start_time:.2f} sec."
-            )
-            return extracted_data
-        except Exception as e:
-            retries += 1
-            logger.error(
-                f"Attempt {retries}/{max_retries} failed to extract results: {e}"
-            )
-            if retries >= max_retries:
-                logger.error("Max retries reached. Failed to extract results.")
-                logger.info(
-                    f"Total time taken before failure: {time() - start_time:.2f} sec."
-                )
-    logger.warning(
-        f"Exhausted all {max_retries} retries. "
-        f"Returning empty list. Total time: {time() - start_time:.2f} sec."
-    )
-    return []
+    def search():
+        return search_torrent_list(
+            query,
+            sources=sources,
+            llm=llm,
+            max_retries=max_retries,
+            on_results=on_results,
+        )
+
+    if not use_cache:
+        return await search()
+    key = search_cache.key(query, sources or list(WEBSITES), llm)
+    return await search_cache.get_or_fetch(key, search)
 
 
 # TOOL DEFINITION
@@ -347,19 +623,21 @@ class ScraperActionProvider(ActionProvider[WalletProvider]):
         name="search-torrents",
         description=(
             "This tool will search for torrents using the provided space-separated keywords "
-            "and return a list of found torrents. Results should NEVER be repeated by the agent "
-            "afterwards, because this tool output is always visible for the user, but you should "
-            "reply to signal the search success or failure and recommend the best file to choose "
-            "from the list, following those specs ordered by priority: greater number of seeds, "
-            "1080p resolution minimum, smaller file size, and avoid x265 encoding (too compute "
-            "intensive on a streaming device). If the results seem to be too heterogeneous, "
-            "recommend to narrow down the search by asking additional keywords. Comply to user's "
-            "request and keep your answer short."
+            "and return a list of found torrents, already ranked from best to worst by score "
+            "(seeds, 1080p resolution, smaller size, no x265 encoding). Results should NEVER be "
+            "repeated by the agent afterwards, because this tool output is always visible for "
+            "the user, but you should reply to signal the search success or failure and "
+            "recommend the first result unless the user asked for something else. If the "
+            "results seem to be too heterogeneous, recommend to narrow down the search by asking "
+            "additional keywords. Comply to user's request and keep your answer short."
         ),
         schema=SearchTorrentsSchema,
     )
-    def search_torrents(self, _args: dict[str, Any]) -> str:
-        torrents = run(find_torrent_list(_args["keywords"]))
+    async def search_torrents(self, _args: dict[str, Any]) -> str:
+        def on_results(torrents: list[dict]):
+            send_partial("search-torrents", dumps(dict(torrents=torrents)))
+
+        torrents = await find_torrent_list(_args["keywords"], on_results=on_results)
         if not torrents:
             logger.error("No result found.")
         return f'<tool-search-torrents>{{"torrents": {dumps(torrents)}}}</tool-search-torrents>'
@@ -0,0 +1,132 @@
+from asyncio import CancelledError, Future, get_running_loop, shield, sleep
+from fcntl import LOCK_EX, LOCK_NB, LOCK_UN, flock
+from hashlib import sha1
+from logging import getLogger
+from os import O_CREAT, O_RDWR, close, fstat, makedirs, path, stat, unlink
+from os import open as open_fd
+from time import time
+from typing import Any, Awaitable, Callable
+
+import coloredlogs
+
+coloredlogs.install()
+logger = getLogger("singleflight")
+
+
+class LeaderCancelled(Exception):
+    pass
+
+
+class SingleFlight:
+    def __init__(
+        self, lock_dir: str, poll_interval: float = 0.2, max_wait: float = 120
+    ):
+        self.lock_dir = lock_dir
+        self.poll_interval = poll_interval
+        self.max_wait = max_wait
+        self._calls: dict[tuple[int, str], Future] = {}
+        makedirs(lock_dir, exist_ok=True)
+
+    def _lock_path(self, key: str) -> str:
+        # One lease per key, unrelated calls never wait on each other
+        return path.join(self.lock_dir, f"flight-{sha1(key.encode()).hexdigest()}.lock")
+
+    @staticmethod
+    def _is_current(fd: int, lock_path: str) -> bool:
+        # The lock file is removed on release, a lease taken on a removed file
+        # is stale and has to be taken again on the new one
+        try:
+            return fstat(fd).st_ino == stat(lock_path).st_ino
+        except FileNotFoundError:
+            return False
+
+    async def _acquire(self, key: str) -> tuple[int, str, bool]:
+        # Returns the locked fd, its path and whether another process was
+        # holding the lease
+        lock_path = self._lock_path(key)
+        waited, deadline = False, time() + self.max_wait
+        while True:
+            fd = open_fd(lock_path, O_CREAT | O_RDWR, 0o644)
+            try:
+                while True:
+                    try:
+                        flock(fd, LOCK_EX | LOCK_NB)
+                        break
+                    except BlockingIOError:
+                        if time() > deadline:
+                            logger.warning(
+                                f"Lease wait timed out, running anyway: {key}"
+                            )
+                            close(fd)
+                            return -1, lock_path, waited
+                        waited = True
+                        await sleep(self.poll_interval)
+            except BaseException:
+                # Cancelled while waiting, by a caller's timeout
+                close(fd)
+                raise
+            if self._is_current(fd, lock_path):
+                return fd, lock_path, waited
+            close(fd)
+
+    @staticmethod
+    def _release(fd: int, lock_path: str):
+        if fd >= 0:
+            # Removed while still locked, so the folder doesn't fill up with keys
+            unlink(lock_path)
+            flock(fd, LOCK_UN)
+            close(fd)
+
+    async def _lead(
+        self,
+        key: str,
+        fetch: Callable[[], Awaitable[Any]],
+        recheck: Callable[[], Awaitable[Any]] | None,
+    ) -> Any:
+        fd, lock_path, waited = await self._acquire(key)
+        try:
+            if waited and recheck is not None:
+                # Another process just ran the same call, reuse its result if stored
+                value = await recheck()
+                if value is not None:
+                    logger.info(f"Coalesced with another process: {key}")
+                    return value
+            return await fetch()
+        finally:
+            self._release(fd, lock_path)
+
+    async def run(
+        self,
+        key: str,
+        fetch: Callable[[], Awaitable[Any]],
+        recheck: Callable[[], Awaitable[Any]] | None = None,
+    ) -> Any:
+        # In-flight calls are tracked per event loop, callers on other loops (or
+        # processes) are coalesced through the lease file instead: fetch stores
+        # its result before returning, for recheck to find it once they get in
+        call_key = (id(get_running_loop()), key)
+        while call_key in self._calls:
+            logger.info(f"Coalesced with in-flight call: {key}")
+            try:
+                return await shield(self._calls[call_key])
+            except LeaderCancelled:
+                # The first follower to wake up takes the call over
+                continue
+
+        future = get_running_loop().create_future()
+        self._calls[call_key] = future
+        try:
+            value = await self._lead(key, fetch, recheck)
+            future.set_result(value)
+            return value
+        except CancelledError:
+            # Only the leader was cancelled, not the followers
+            future.set_exception(LeaderCancelled(key))
+            future.exception()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()  # Avoid "exception never retrieved" without followers
+            raise
+        finally:
+            self._calls.pop(call_key, None)
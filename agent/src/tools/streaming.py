@@ -0,0 +1,236 @@
+from asyncio import sleep, to_thread
+from base64 import urlsafe_b64encode
+from hashlib import sha256
+from hmac import compare_digest, new
+from logging import getLogger
+from mimetypes import guess_type
+from os import O_RDONLY, chmod, close, getpid, link, makedirs, path, pread, remove
+from os import open as open_fd
+from os import urandom
+from time import time
+from typing import Any, AsyncIterator
+from urllib.parse import quote
+
+import coloredlogs
+
+coloredlogs.install()
+logger = getLogger("streaming")
+
+from .jobs import FINAL_STATUSES, JobQueue
+from .torrents import TorrentClient
+
+
+class StreamError(Exception):
+    def __init__(
+        self, status_code: int, message: str, headers: dict[str, str] | None = None
+    ):
+        super().__init__(message)
+        self.status_code = status_code
+        self.message = message
+        self.headers = headers or {}
+
+
+def parse_range(header: str | None, size: int) -> tuple[int, int] | None:
+    # First range of "bytes=start-end", "bytes=start-" or "bytes=-suffix", end
+    # included. None for the whole file, ValueError when out of the file
+    if not header or not header.strip().startswith("bytes="):
+        return None
+    start, _, end = header.strip()[6:].split(",")[0].strip().partition("-")
+    if not start:
+        if not end.isdigit() or int(end) == 0 or size == 0:
+            raise ValueError(f"Unsatisfiable range: {header}")
+        return max(size - int(end), 0), size - 1
+    if not start.isdigit() or int(start) >= size or (end and not end.isdigit()):
+        raise ValueError(f"Unsatisfiable range: {header}")
+    if end and int(end) < int(start):
+        raise ValueError(f"Unsatisfiable range: {header}")
+    return int(start), min(int(end), size - 1) if end else size - 1
+
+
+def job_files(job: dict[str, Any]) -> dict[str, dict[str, int]]:
+    # Wanted files by path in the downloads folder, with their size and
+    # verified bytes from the start, final once the job is done
+    return (job["result"] or {}).get("files") or (job["progress"] or {}).get(
+        "files", {}
+    )
+
+
+class StreamTokens:
+    # Signed expiring tokens tied to a job id, the key is shared by every
+    # server process through the data folder unless given
+    def __init__(self, key_path: str, ttl: float = 86400, secret: str | None = None):
+        self.key_path = key_path
+        self.ttl = ttl
+        self._key = secret.encode() if secret else None
+
+    def _load_key(self) -> bytes:
+        if self._key is None:
+            if not path.exists(self.key_path):
+                makedirs(path.dirname(self.key_path), exist_ok=True)
+                # Written aside then linked, the first process wins
+                temp_path = f"{self.key_path}.{getpid()}"
+                with open(temp_path, "wb") as file:
+                    chmod(temp_path, 0o600)
+                    file.write(urandom(32))
+                try:
+                    link(temp_path, self.key_path)
+                except FileExistsError:
+                    pass
+                remove(temp_path)
+            with open(self.key_path, "rb") as file:
+                self._key = file.read()
+        return self._key
+
+    def _signature(self, job_id: str, expires: int) -> str:
+        digest = new(self._load_key(), f"{job_id}.{expires}".encode(), sha256)
+        return urlsafe_b64encode(digest.digest()[:18]).decode()
+
+    def sign(self, job_id: str) -> str:
+        expires = int(time() + self.ttl)
+        return f"{expires}.{self._signature(job_id, expires)}"
+
+    def verify(self, job_id: str, token: str) -> bool:
+        expires, _, signature = token.partition(".")
+        if not expires.isdigit() or int(expires) < time():
+            return False
+        return compare_digest(signature, self._signature(job_id, int(expires)))
+
+
+class FileStreamer:
+    # Serves the files of a job straight from the downloads folder with range
+    # requests, while they are still downloading: the pieces come in order and
+    # a seek asks for its pieces first when the torrent runs in this process
+    def __init__(
+        self,
+        directory: str,
+        jobs: JobQueue,
+        torrents: TorrentClient,
+        tokens: StreamTokens,
+        base_url: str,
+        chunk_size: int = 1024**2,
+        max_range: int = 8 * 1024**2,
+        poll_interval: float = 0.5,
+        stall_timeout: float = 60,
+    ):
+        self.directory = directory
+        self.jobs = jobs
+        self.torrents = torrents
+        self.tokens = tokens
+        self.base_url = base_url.rstrip("/")
+        self.chunk_size = chunk_size
+        self.max_range = max_range
+        self.poll_interval = poll_interval
+        self.stall_timeout = stall_timeout
+
+    def urls(self, job: dict[str, Any]) -> dict[str, str]:
+        token = self.tokens.sign(job["id"])
+        return {
+            name: f"{self.base_url}/v1/jobs/{job['id']}/file"
+            f"?token={token}&file={quote(name)}"
+            for name in job_files(job)
+        }
+
+    async def open(
+        self, job_id: str, token: str, name: str | None, range_header: str | None
+    ) -> tuple[int, dict[str, str], AsyncIterator[bytes]]:
+        # Returns the status code, headers and chunks of the response
+        if not self.tokens.verify(job_id, token):
+            raise StreamError(403, "Invalid or expired token")
+        job = await self.jobs.get(job_id)
+        if job is None:
+            raise StreamError(404, "Job not found")
+        files = job_files(job)
+        if name is None and len(files) == 1:
+            name = next(iter(files))
+        if name not in files:
+            raise StreamError(404, "File not found, or not known yet")
+        if job["status"] in FINAL_STATUSES and job["status"] != "done":
+            raise StreamError(410, f"Download {job['status']}: {job['error']}")
+        file_path = path.realpath(path.join(self.directory, name))
+        if not file_path.startswith(path.realpath(self.directory) + path.sep):
+            raise StreamError(404, "File not found")
+        if job["status"] == "done" and not path.isfile(file_path):
+            raise StreamError(410, "No longer on the disk")
+        size = files[name]["size"]
+        try:
+            byte_range = parse_range(range_header, size)
+        except ValueError as e:
+            raise StreamError(416, str(e), {"Content-Range": f"bytes */{size}"})
+        start, end = byte_range or (0, size - 1)
+        if byte_range:
+            # Sent whole to keep their length, players ask for the next range
+            end = min(end, start + self.max_range - 1)
+        headers = {
+            "Content-Type": guess_type(name)[0] or "application/octet-stream",
+            "Content-Length": str(end - start + 1),
+            "Accept-Ranges": "bytes",
+            "Content-Disposition": f'inline; filename="{path.basename(name)}"',
+        }
+        if byte_range:
+            headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        logger.info(f"Streaming {name} ({start}-{end}/{size}), job {job_id}")
+        return (
+            206 if byte_range else 200,
+            headers,
+            self._read(job, name, file_path, start, end + 1),
+        )
+
+    @staticmethod
+    async def read_range(
+        headers: dict[str, str], chunks: AsyncIterator[bytes]
+    ) -> tuple[dict[str, str], bytes]:
+        # Whole body of a range response, narrowed to what was read when the
+        # download stalled or failed on the way
+        body = b"".join([chunk async for chunk in chunks])
+        if not body:
+            raise StreamError(503, "Not downloaded yet", {"Retry-After": "5"})
+        if len(body) < int(headers["Content-Length"]):
+            byte_range, _, size = headers["Content-Range"][6:].partition("/")
+            start = int(byte_range.partition("-")[0])
+            headers = dict(headers)
+            headers["Content-Range"] = f"bytes {start}-{start + len(body) - 1}/{size}"
+            headers["Content-Length"] = str(len(body))
+        return headers, body
+
+    def _ready(
+        self, job: dict[str, Any], name: str, file_path: str, offset: int, length: int
+    ) -> int:
+        if job["status"] == "done":
+            return length
+        available = self.torrents.available(file_path, offset, length)
+        if available is not None:
+            return available
+        # Downloading in another process, only its verified start is known
+        ready = job_files(job).get(name, {}).get("ready", 0)
+        return max(min(ready - offset, length), 0)
+
+    async def _read(
+        self, job: dict[str, Any], name: str, file_path: str, start: int, end: int
+    ) -> AsyncIterator[bytes]:
+        fd = None
+        offset, waiting_since = start, time()
+        try:
+            while offset < end:
+                ready = self._ready(
+                    job, name, file_path, offset, min(self.chunk_size, end - offset)
+                )
+                if not ready:
+                    if job["status"] in FINAL_STATUSES:
+                        return
+                    if time() - waiting_since > self.stall_timeout:
+                        logger.warning(f"Stream of {name} stalled at byte {offset}")
+                        return
+                    await sleep(self.poll_interval)
+                    job = await self.jobs.get(job["id"]) or job
+                    continue
+                if fd is None:
+                    fd = open_fd(file_path, O_RDONLY)
+                data = await to_thread(pread, fd, ready, offset)
+                if not data:
+                    return
+                offset += len(data)
+                waiting_since = time()
+                yield data
+        finally:
+            if fd is not None:
+                close(fd)
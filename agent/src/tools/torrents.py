@@ -0,0 +1,371 @@
+from asyncio import sleep
+from logging import getLogger
+from os import makedirs, path, remove, replace
+from time import time
+from typing import Awaitable, Callable
+
+import coloredlogs
+
+coloredlogs.install()
+logger = getLogger("torrents")
+
+import libtorrent as lt
+
+ProgressCallback = Callable[[str, dict], Awaitable[None]]
+# Picks the index of the wanted file from the torrent's file paths and sizes,
+# None for all
+FileSelector = Callable[[list[str], list[int]], Awaitable[int | None]]
+# Called with the path of every wanted file once all its pieces are verified
+FileCallback = Callable[[str], Awaitable[None]]
+# Pieces asked for ahead of a streamed position, in bytes
+STREAM_READAHEAD = 16 * 1024**2
+
+
+def info_key(info_hashes: lt.info_hash_t) -> str:
+    # v1 (btih) when available, as found in the scraped magnet links
+    return str(info_hashes.v1 if info_hashes.has_v1() else info_hashes.get_best())
+
+
+def infohash(magnet_link: str) -> str:
+    return info_key(lt.parse_magnet_uri(magnet_link).info_hashes)
+
+
+def torrent_progress(
+    status: lt.torrent_status,
+    file_done: int | None = None,
+    file_size: int | None = None,
+) -> dict:
+    # Covers a single file when given, the whole torrent otherwise
+    bytes_done = status.total_wanted_done if file_done is None else file_done
+    bytes_total = status.total_wanted if file_size is None else file_size
+    remaining = bytes_total - bytes_done
+    return dict(
+        state=str(status.state),
+        progress=round(bytes_done / bytes_total * 100, 1) if bytes_total else 0.0,
+        bytes_done=bytes_done,
+        bytes_total=bytes_total,
+        download_rate=status.download_rate,
+        upload_rate=status.upload_rate,
+        peers=status.num_peers,
+        seeds=status.num_seeds,
+        eta=int(remaining / status.download_rate) if status.download_rate else None,
+    )
+
+
+class TorrentClient:
+    def __init__(
+        self,
+        save_path: str,
+        port: int = 6881,
+        poll_interval: float = 1,
+        metadata_timeout: float = 300,
+        download_budget: int = 0,
+        upload_budget: int = 0,
+        resume_dir: str | None = None,
+        resume_interval: float = 30,
+    ):
+        self.save_path = save_path
+        # Fast-resume data by infohash, downloads pick up where they stopped
+        # without rechecking their pieces after a restart
+        self.resume_dir = resume_dir or path.join(path.dirname(save_path), "resume")
+        self.resume_interval = resume_interval
+        self.port = port
+        self.poll_interval = poll_interval
+        self.metadata_timeout = metadata_timeout
+        # Bytes/sec for all the server processes together, 0 means unlimited
+        self.download_budget = download_budget
+        self.upload_budget = upload_budget
+        self._session: lt.session | None = None
+        # Downloads sharing a torrent handle, with the file each one wants
+        self._users: dict[str, int] = {}
+        self._wanted: dict[str, dict[object, int | None]] = {}
+        self._saving: set[str] = set()
+        # Wanted files by path, with their verified bytes from the start
+        self._streams: dict[str, tuple[lt.torrent_handle, int]] = {}
+        self._ready: dict[str, int] = {}
+
+    def start(self):
+        # One libtorrent session per process, shared by every download
+        if self._session is None:
+            self._session = lt.session(
+                {
+                    "listen_interfaces": f"0.0.0.0:{self.port},[::]:{self.port}",
+                    "user_agent": "aipfs-library",
+                    "alert_mask": lt.alert_category.error
+                    | lt.alert_category.status
+                    | lt.alert_category.storage,
+                    "download_rate_limit": self.download_budget,
+                    "upload_rate_limit": self.upload_budget,
+                }
+            )
+            logger.info("Torrent session: ready")
+
+    def set_budget_share(self, share: float):
+        # Gives this process its share of the global rate budgets
+        if self._session is None:
+            return
+        self._session.apply_settings(
+            {
+                "download_rate_limit": (
+                    max(int(self.download_budget * share), 1)
+                    if self.download_budget
+                    else 0
+                ),
+                "upload_rate_limit": (
+                    max(int(self.upload_budget * share), 1) if self.upload_budget else 0
+                ),
+            }
+        )
+
+    def close(self):
+        if self._session is not None:
+            self._session.pause()
+            self._session = None
+            logger.info("Torrent session: closed")
+
+    def _resume_path(self, key: str) -> str:
+        return path.join(self.resume_dir, f"{key}.fastresume")
+
+    def _load_resume_data(self, key: str) -> lt.add_torrent_params | None:
+        try:
+            with open(self._resume_path(key), "rb") as file:
+                params = lt.read_resume_data(file.read())
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning(f"Unusable resume data for {key}: {e}")
+            return None
+        logger.info(f"Resuming {key} from its fast-resume data")
+        return params
+
+    def _handle_alerts(self):
+        for alert in self._session.pop_alerts():
+            if isinstance(alert, lt.save_resume_data_alert):
+                key = info_key(alert.handle.info_hashes())
+                makedirs(self.resume_dir, exist_ok=True)
+                # Written aside then renamed, a crash never leaves half a file
+                with open(f"{self._resume_path(key)}.tmp", "wb") as file:
+                    file.write(lt.write_resume_data_buf(alert.params))
+                replace(f"{self._resume_path(key)}.tmp", self._resume_path(key))
+                self._saving.discard(key)
+            elif isinstance(alert, lt.save_resume_data_failed_alert):
+                key = info_key(alert.handle.info_hashes())
+                if "not modified" not in alert.message():
+                    logger.warning(
+                        f"Resume data not saved for {key}: {alert.message()}"
+                    )
+                self._saving.discard(key)
+
+    def _request_resume_data(self, key: str, handle: lt.torrent_handle):
+        if handle.is_valid() and handle.status().has_metadata:
+            self._saving.add(key)
+            handle.save_resume_data(
+                lt.torrent_handle.save_info_dict | lt.torrent_handle.only_if_modified
+            )
+
+    async def _save_resume_data(self, key: str, handle: lt.torrent_handle):
+        self._request_resume_data(key, handle)
+        deadline = time() + 5
+        while key in self._saving and time() < deadline:
+            await sleep(0.1)
+            self._handle_alerts()
+        # Gives up after a while, the last periodic save is still there
+        self._saving.discard(key)
+
+    def forget(self, magnet_link: str):
+        # Once the content is stored elsewhere, a restart has nothing to resume
+        try:
+            remove(self._resume_path(infohash(magnet_link)))
+        except FileNotFoundError:
+            pass
+
+    def add(self, magnet_link: str, metadata_only: bool = False) -> lt.torrent_handle:
+        self.start()
+        params = lt.parse_magnet_uri(magnet_link)
+        handle = self._session.find_torrent(params.info_hashes.get_best())
+        if handle.is_valid():
+            return handle
+        resume = self._load_resume_data(infohash(magnet_link))
+        if resume is not None:
+            # Peers and trackers of the magnet link are still worth asking
+            resume.trackers = list(dict.fromkeys([*resume.trackers, *params.trackers]))
+            resume.peers = [*resume.peers, *params.peers]
+            params = resume
+        params.save_path = self.save_path
+        if metadata_only:
+            # No piece is requested until the files to download are chosen
+            params.flags |= lt.torrent_flags.upload_mode
+        return self._session.add_torrent(params)
+
+    def remove(self, handle: lt.torrent_handle):
+        # Files are kept on disk, only the torrent stops (no seeding)
+        if self._session is not None and handle.is_valid():
+            self._session.remove_torrent(handle)
+
+    def files(self, handle: lt.torrent_handle) -> dict[int, str]:
+        # Absolute paths by file index, without the padding files
+        storage = handle.torrent_file().files()
+        return {
+            index: path.join(self.save_path, storage.file_path(index))
+            for index in range(storage.num_files())
+            if not storage.file_flags(index) & lt.file_storage.flag_pad_file
+        }
+
+    def _ready_bytes(self, handle: lt.torrent_handle, index: int) -> int:
+        # Verified bytes from the start of a file, what any process can stream
+        info = handle.torrent_file()
+        storage = info.files()
+        start, size = storage.file_offset(index), storage.file_size(index)
+        file_path = path.join(self.save_path, storage.file_path(index))
+        ready = self._ready.get(file_path, 0)
+        piece = (start + ready) // info.piece_length()
+        while ready < size and handle.have_piece(piece):
+            piece += 1
+            ready = min(piece * info.piece_length() - start, size)
+        self._ready[file_path] = ready
+        return ready
+
+    def available(self, file_path: str, offset: int, length: int) -> int | None:
+        # Verified bytes from the offset of a file downloading in this process,
+        # the missing pieces are asked for first. None when it is not here
+        if file_path not in self._streams:
+            return None
+        handle, index = self._streams[file_path]
+        if not handle.is_valid():
+            return None
+        info = handle.torrent_file()
+        storage = info.files()
+        start = storage.file_offset(index) + offset
+        end = start + max(min(length, storage.file_size(index) - offset), 0)
+        piece_length = info.piece_length()
+        ready = start
+        for piece in range(start // piece_length, -(-end // piece_length)):
+            if not handle.have_piece(piece):
+                last = min(
+                    piece + -(-STREAM_READAHEAD // piece_length), info.num_pieces()
+                )
+                for rank, missing in enumerate(range(piece, last)):
+                    if not handle.have_piece(missing):
+                        handle.set_piece_deadline(missing, rank * 100)
+                break
+            ready = min((piece + 1) * piece_length, end)
+        return ready - start
+
+    def _prioritize(self, key: str, handle: lt.torrent_handle):
+        wanted = set(self._wanted.get(key, {}).values())
+        if not wanted or not handle.is_valid():
+            return
+        num_files = handle.torrent_file().num_files()
+        if None in wanted:
+            handle.prioritize_files([4] * num_files)
+        else:
+            handle.prioritize_files(
+                [7 if index in wanted else 0 for index in range(num_files)]
+            )
+        handle.unset_flags(lt.torrent_flags.upload_mode)
+
+    async def _wait_for_metadata(
+        self, handle: lt.torrent_handle, on_progress: ProgressCallback | None
+    ):
+        deadline = time() + self.metadata_timeout
+        while not (status := handle.status()).has_metadata:
+            if on_progress:
+                await on_progress("metadata", torrent_progress(status))
+            if time() > deadline:
+                raise TimeoutError(
+                    f"No metadata received after {self.metadata_timeout} sec."
+                )
+            await sleep(self.poll_interval)
+
+    async def download(
+        self,
+        magnet_link: str,
+        on_progress: ProgressCallback | None = None,
+        select: FileSelector | None = None,
+        on_file: FileCallback | None = None,
+    ) -> str:
+        # Returns the path of the selected file, or of the whole torrent
+        key = infohash(magnet_link)
+        resumed = path.exists(self._resume_path(key))
+        handle = self.add(magnet_link, metadata_only=select is not None)
+        self._users[key] = self._users.get(key, 0) + 1
+        wanted = self._wanted.setdefault(key, {})
+        token = object()
+        last_save = time()
+        try:
+            await self._wait_for_metadata(handle, on_progress)
+            files = self.files(handle)
+            storage = handle.torrent_file().files()
+            index = None
+            if select:
+                index = await select(
+                    list(files.values()), [storage.file_size(index) for index in files]
+                )
+                index = list(files)[index] if index is not None else None
+            wanted[token] = index
+            self._prioritize(key, handle)
+            if index is not None:
+                logger.info(f"Downloading only: {files[index]}")
+            # Pieces come in order: files complete one after the other, handed
+            # over while the rest downloads, and can be streamed from the start
+            handle.set_flags(lt.torrent_flags.sequential_download)
+            indexes = list(files) if index is None else [index]
+            for file_index in indexes:
+                self._streams[files[file_index]] = (handle, file_index)
+            completed = set()
+            while True:
+                self._handle_alerts()
+                if time() - last_save > self.resume_interval:
+                    last_save = time()
+                    self._request_resume_data(key, handle)
+                status = handle.status()
+                # Only counts the pieces that passed the hash check
+                files_done = handle.file_progress(
+                    flags=lt.torrent_handle.piece_granularity
+                )
+                for file_index in indexes:
+                    if file_index not in completed and files_done[
+                        file_index
+                    ] >= storage.file_size(file_index):
+                        completed.add(file_index)
+                        if on_file:
+                            await on_file(files[file_index])
+                if index is None:
+                    progress = torrent_progress(status)
+                else:
+                    progress = torrent_progress(
+                        status, files_done[index], storage.file_size(index)
+                    )
+                progress["files"] = {
+                    storage.file_path(file_index): dict(
+                        size=storage.file_size(file_index),
+                        ready=self._ready_bytes(handle, file_index),
+                    )
+                    for file_index in indexes
+                }
+                if resumed:
+                    # Picked up from the fast-resume data, not started over
+                    progress["resumed"] = True
+                if on_progress:
+                    await on_progress("downloading", progress)
+                if len(completed) == len(indexes):
+                    if index is None:
+                        return path.join(self.save_path, handle.torrent_file().name())
+                    return files[index]
+                await sleep(self.poll_interval)
+        finally:
+            # Refused by on_progress, timed out, cancelled or done
+            wanted.pop(token, None)
+            self._users[key] -= 1
+            if self._users[key] == 0:
+                del self._users[key]
+                self._wanted.pop(key, None)
+                for file_path, (other, _) in list(self._streams.items()):
+                    if other == handle:
+                        del self._streams[file_path]
+                        self._ready.pop(file_path, None)
+                # Kept even once finished, until the job is done with the files
+                await self._save_resume_data(key, handle)
+                self.remove(handle)
+            else:
+                self._prioritize(key, handle)